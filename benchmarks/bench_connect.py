@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+offline microbenchmarks of the hot paths in umeng_push/services/message/connect.py
+
+usage:
+    python benchmarks/bench_connect.py [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+
+exits with status 1 when a case is slower than the baseline by more than threshold
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from umeng_push.services.message.connect import UMMessage, UMNotification, DeviceType  # noqa: E402
+from umeng_push.services.message.template import CompiledMessage  # noqa: E402
+
+
+DEVICE_COUNTS = (1, 10, 50, 500)
+FLEETS = {
+    'android': lambda i: DeviceType.android,
+    'ios': lambda i: DeviceType.ios,
+    'mixed': lambda i: DeviceType.android if i % 2 else DeviceType.ios,
+}
+SUCCESS_TEXT = json.dumps({'ret': 'SUCCESS', 'data': {'msg_id': 'uu0000000000000000', 'thirdparty_id': 'tp'}})
+
+
+def build_notification():
+    notification = UMNotification(ticker='有人投票',
+                                  title='有人投票',
+                                  text='有人给你的照片投了一票，快去看看吧',
+                                  play_vibrate=True,
+                                  extra={'display_type': 'notification', 'badge': 1})
+    notification.set_go_custom('follow')
+    return notification
+
+
+def build_message(cast, fleet, count):
+    message = UMMessage(out_biz_no='bench', description='bench', app_key='app_key', app_master_secret='secret')
+    device_type = FLEETS[fleet]
+    devices = [('{:044d}'.format(i), device_type(i)) for i in range(count)]
+    if cast == 'unicast':
+        message.set_unicast(*devices[0])
+    elif cast == 'listcast':
+        message.set_listcast(devices)
+    else:
+        message.set_broadcast()
+    return message.set_notification(build_notification())
+
+
+def cases():
+    for cast in ('unicast', 'listcast', 'broadcast'):
+        for fleet in FLEETS:
+            for count in (DEVICE_COUNTS if cast == 'listcast' else (1, )):
+                message = build_message(cast, fleet, count)
+                yield 'build_params/{}/{}/{}'.format(cast, fleet, count), message._build_params
+
+    message = build_message('listcast', 'android', 50)
+    android_params, _ = message._build_params()
+    yield 'encode_body/listcast/50', lambda: message._encode_body(android_params, 0)
+    post_body = message._encode_body(android_params, 0)
+    yield 'build_sign/listcast/50', lambda: message._build_sign(post_body)
+
+    compiled = build_message('unicast', 'android', 1).compile()
+    yield 'template_render/unicast', lambda: compiled.render('0' * 44, DeviceType.android, 'bench', 0)
+    queued_message = compiled.message.to_bytes()
+    queued_compiled = compiled.to_bytes()
+    yield 'compiled/from_message_bytes', lambda: UMMessage.from_bytes(queued_message, 'secret').compile()
+    yield 'compiled/from_bytes', lambda: CompiledMessage.from_bytes(queued_compiled, 'secret')
+
+    notification = build_notification()
+    text = str(notification)
+    yield 'notification/str', lambda: str(notification)
+    yield 'notification/load_data', lambda: UMNotification.load_data(text)
+    yield 'notification/round_trip', lambda: UMNotification.load_data(str(notification))
+    data = notification.to_bytes()
+    yield 'notification/to_bytes', notification.to_bytes
+    yield 'notification/from_bytes', lambda: UMNotification.from_bytes(data)
+    yield 'notification/bytes_round_trip', lambda: UMNotification.from_bytes(notification.to_bytes())
+    yield 'notification/dict_round_trip', lambda: UMNotification.from_dict(notification.to_dict())
+
+    for count in (1, 50):
+        queued = build_message('listcast', 'mixed', count)
+        yield 'message/bytes_round_trip/{}'.format(count), \
+            lambda queued=queued: UMMessage.from_bytes(queued.to_bytes(), 'secret')
+        yield 'message/json_round_trip/{}'.format(count), \
+            lambda queued=queued: UMMessage.from_dict(json.loads(json.dumps(queued.to_dict())), 'secret')
+
+    yield 'process_rt_data/success', lambda: message._process_rt_data(SUCCESS_TEXT)
+
+
+def sizes():
+    """
+    encoded size in bytes of each serialization format
+    """
+    notification = build_notification()
+    message = build_message('listcast', 'mixed', 50)
+    return {'notification/str': len(str(notification).encode()),
+            'notification/to_bytes': len(notification.to_bytes()),
+            'message/json/50': len(json.dumps(message.to_dict()).encode()),
+            'message/to_bytes/50': len(message.to_bytes())}
+
+
+def measure(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    timings = timer.repeat(repeat=repeat, number=number)
+    return {'best_us': min(timings) / number * 1e6,
+            'mean_us': sum(timings) / len(timings) / number * 1e6,
+            'number': number,
+            'repeat': repeat}
+
+
+def run(repeat, min_time, select=None):
+    results = {}
+    # keep any configured log handlers out of the measurement
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, func in cases():
+            if select and select not in name:
+                continue
+            results[name] = measure(func, repeat, min_time)
+    logging.disable(logging.NOTSET)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    return the names of cases slower than baseline by more than threshold
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print('{:45s} {:10.2f}us      (new)'.format(name, result['best_us']))
+            continue
+        change = result['best_us'] / base['best_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:45s} {:10.2f}us {:+7.1%}{}'.format(name, result['best_us'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--baseline', help='json results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per repeat')
+    parser.add_argument('--select', help='only run cases whose name contains this string')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.min_time, args.select)
+    document = {'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'results': results,
+                'sizes': sizes()}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+            return 1
+    else:
+        for name, result in sorted(results.items()):
+            print('{:45s} {:10.2f}us'.format(name, result['best_us']))
+        for name, size in sorted(document['sizes'].items()):
+            print('{:45s} {:10d} bytes'.format(name, size))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
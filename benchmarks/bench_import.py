@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+cold import time of umeng_push.services.message.connect, each sample in a fresh interpreter
+
+usage:
+    python benchmarks/bench_import.py [--runs 20] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROBE = '''
+import sys, time
+started = time.perf_counter()
+import umeng_push.services.message.connect
+elapsed = time.perf_counter() - started
+heavy = sorted(name for name in ('django', 'requests', 'urllib3', 'concurrent.futures', 'tempfile')
+               if name in sys.modules)
+print(repr((elapsed, heavy)))
+'''
+
+
+def sample():
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT))
+    import ast
+    return ast.literal_eval(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.runs)]
+    timings = sorted(elapsed for elapsed, _ in samples)
+    result = {'runs': args.runs,
+              'best_ms': timings[0] * 1000,
+              'median_ms': timings[len(timings) // 2] * 1000,
+              'heavy_modules': samples[-1][1]}
+    print('import connect: best {best_ms:.2f}ms median {median_ms:.2f}ms, heavy modules loaded: {heavy_modules}'
+          .format(**result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+memory held by queued models and device lists, measured with tracemalloc
+
+usage:
+    python benchmarks/bench_memory.py [--count 100000] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from umeng_push.services.message.connect import UMMessage, UMNotification, MsgReturnData, DeviceType  # noqa: E402
+
+
+def notification(i):
+    n = UMNotification(ticker='ticker', title='title', text='text')
+    n.set_go_custom('follow')
+    return n
+
+
+def message(i):
+    return UMMessage(out_biz_no='biz', description='bench', app_key='app_key', app_master_secret='secret')
+
+
+def return_data(i):
+    return MsgReturnData(ret='SUCCESS', thirdparty_id=None, msg_id='uu')
+
+
+CASES = {
+    'UMNotification': notification,
+    'UMMessage': message,
+    'MsgReturnData': return_data,
+}
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / float(count)
+
+
+def measure_devices(count):
+    """
+    bytes per device kept by a listcast message, the tokens themselves are not counted
+    """
+    tokens = ['{:044d}'.format(i) for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    m = message(0).set_listcast([(token, DeviceType.android if i % 2 else DeviceType.ios)
+                                 for i, token in enumerate(tokens)])
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del m
+    return (after - before) / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for name, factory in sorted(CASES.items()):
+        results[name] = measure(factory, args.count)
+    results['set_listcast_per_device'] = measure_devices(args.count)
+
+    for name, size in sorted(results.items()):
+        print('{:28s} {:8.1f} bytes'.format(name, size))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'count': args.count, 'bytes': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+end to end load test of UMMessage against the local stub server
+
+usage:
+    python benchmarks/loadtest.py --concurrency 1,8,32,128 --requests 2000 --latency exp:0.02 --fail 4001:0.01
+    python benchmarks/loadtest.py --url http://127.0.0.1:8080 --secret secret   # a stub server started separately
+
+reports throughput, p50/p99 latency and error rate per concurrency level, --output writes them as json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stub_server import StubServer  # noqa: E402
+from umeng_push.services.message.connect import UMMessage, UMNotification, DeviceType  # noqa: E402
+from umeng_push.services.message.transport import configure_transport  # noqa: E402
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def build_message(url, secret, index, devices, message_options):
+    message = UMMessage(out_biz_no='load-{}'.format(index),
+                        description='load test',
+                        app_key='app_key',
+                        app_master_secret=secret,
+                        **message_options)
+    message.url = url + '/api/send'
+    if devices == 1:
+        message.set_unicast('{:044d}'.format(index), DeviceType.android)
+    else:
+        message.set_listcast([('{:044d}'.format(index * devices + i), i % 2) for i in range(devices)])
+    notification = UMNotification(ticker='load', title='load', text='load test')
+    notification.set_go_custom('load')
+    return message.set_notification(notification)
+
+
+def run_level(url, secret, concurrency, requests, devices, concurrent, message_options):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def _push(index):
+        message = build_message(url, secret, index, devices, message_options)
+        started = time.perf_counter()
+        results = message.push(concurrent=concurrent)
+        elapsed = time.perf_counter() - started
+        failed = any(data is None or data.ret != 'SUCCESS'
+                     for params, data in zip((message.android_params, message.ios_params), results) if params)
+        with lock:
+            latencies.append(elapsed)
+            if failed:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(_push, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {'concurrency': concurrency,
+            'requests': requests,
+            'seconds': elapsed,
+            'throughput': requests / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'error_rate': errors[0] / float(requests)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base url of a running stub server, default starts one in process')
+    parser.add_argument('--secret', default='secret')
+    parser.add_argument('--concurrency', default='1,8,32,128', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=1000, help='pushes per concurrency level')
+    parser.add_argument('--devices', type=int, default=1, help='1 for unicast, more for a mixed listcast')
+    parser.add_argument('--concurrent-platforms', action='store_true', help='push(concurrent=True)')
+    parser.add_argument('--latency', help='stub latency distribution, e.g. exp:0.02')
+    parser.add_argument('--fail', help='stub injected failures, e.g. 2026:0.01,4001:0.02,2028:0.01')
+    parser.add_argument('--pool-maxsize', type=int, default=128)
+    parser.add_argument('--retry', action='store_true', help='send with a default RetryPolicy')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    server = None
+    url = args.url
+    if url is None:
+        server = StubServer(('127.0.0.1', 0), args.secret, args.latency, args.fail).start()
+        url = server.url
+
+    configure_transport(pool_maxsize=args.pool_maxsize)
+    message_options = {}
+    if args.retry:
+        from umeng_push.services.message.retry import RetryPolicy
+        message_options['retry_policy'] = RetryPolicy()
+
+    results = []
+    print('{:>11s} {:>9s} {:>10s} {:>9s} {:>9s} {:>7s}'.format(
+        'concurrency', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    devnull = open(os.devnull, 'w')
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            result = run_level(url, args.secret, concurrency, args.requests, args.devices,
+                               args.concurrent_platforms, message_options)
+        finally:
+            sys.stdout = stdout
+        results.append(result)
+        print('{concurrency:>11d} {requests:>9d} {throughput:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} '
+              '{error_rate:>7.2%}'.format(**result))
+    devnull.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': url, 'devices': args.devices, 'results': results}, f, indent=2)
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+local stand-in for msg.umeng.com, for load tests that must not reach the real API
+
+usage:
+    python benchmarks/stub_server.py --port 8080 --secret secret --latency exp:0.02 --fail 2026:0.01,4001:0.02
+
+latency:  const:SECONDS | uniform:LOW,HIGH | exp:MEAN | lognormal:MEDIAN,SIGMA
+fail:     comma separated APIServerErrorCode:probability pairs, answered with HTTP 500 like the real API
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from umeng_push.services.message.error_codes import APIServerErrorCode  # noqa: E402
+
+
+TIMESTAMP_TOLERANCE = 10 * 60 * 1000  # 毫秒
+
+# broadcast/groupcast/filecast/customizedcast 返回 task_id，任务在该时间内从排队变为发送完成
+TASK_DURATION = 2.0  # 秒
+TASK_TYPES = ('broadcast', 'groupcast', 'filecast', 'customizedcast')
+
+
+def parse_latency(spec):
+    """
+    return a function returning one latency sample in seconds
+    """
+    if not spec:
+        return lambda: 0.0
+    kind, _, values = spec.partition(':')
+    values = [float(value) for value in values.split(',') if value]
+    if kind == 'const':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / values[0])
+    if kind == 'lognormal':
+        import math
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError('unknown latency distribution {}'.format(spec))
+
+
+def parse_failures(spec):
+    """
+    return [(APIServerErrorCode, probability)]
+    """
+    failures = []
+    for item in (spec or '').split(','):
+        if item:
+            code, probability = item.split(':')
+            failures.append((APIServerErrorCode(int(code)), float(probability)))
+    return failures
+
+
+class StubStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = {}
+
+    def count(self, error_code=None):
+        with self.lock:
+            self.requests += 1
+            if error_code is not None:
+                self.errors[error_code] = self.errors.get(error_code, 0) + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def __reply(self, status, ret, data):
+        body = json.dumps({'ret': ret, 'data': data}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __fail(self, error_code):
+        self.server.stats.count(error_code.value)
+        self.__reply(500, 'FAIL', {'error_code': str(error_code.value)})
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlsplit(self.path)
+        time.sleep(max(0.0, server.latency()))
+
+        # the client signs the url it posts to, without the query string
+        full_url = 'http://{}{}'.format(self.headers.get('Host'), url.path)
+        sign = hashlib.md5(b''.join([b'POST', full_url.encode(), body, server.secret.encode()])).hexdigest()
+        if parse_qs(url.query).get('sign', [None])[0] != sign:
+            return self.__fail(APIServerErrorCode.WRONG_SIGNATURE)
+        try:
+            params = json.loads(body.decode())
+        except ValueError:
+            return self.__fail(APIServerErrorCode.WRONG_JSON)
+        if abs(time.time() * 1000 - int(params.get('timestamp', 0))) > TIMESTAMP_TOLERANCE:
+            return self.__fail(APIServerErrorCode.TIMESTAMP_EXPIRED)
+
+        for error_code, probability in server.failures:
+            if random.random() < probability:
+                return self.__fail(error_code)
+
+        if url.path == '/upload':
+            server.stats.count()
+            return self.__reply(200, 'SUCCESS', {'file_id': uuid.uuid4().hex})
+        if url.path == '/api/status':
+            return self.__task_status(params.get('task_id'))
+        if url.path == '/api/cancel':
+            return self.__task_cancel(params.get('task_id'))
+        if url.path != '/api/send':
+            self.server.stats.count(404)
+            return self.__reply(404, 'FAIL', {})
+
+        tokens = [token for token in params.get('device_tokens', '').split(',') if token]
+        if len(tokens) > 50:
+            return self.__fail(APIServerErrorCode.DEVICE_TOKENS_GREATER_THAN_FIFTY)
+        server.stats.count()
+        if params.get('type') in TASK_TYPES:
+            data = {'task_id': server.add_task()}
+        else:
+            data = {'msg_id': uuid.uuid4().hex}
+        if 'thirdparty_id' in params:
+            data['thirdparty_id'] = params['thirdparty_id']
+        self.__reply(200, 'SUCCESS', data)
+
+    def __task_status(self, task_id):
+        task = self.server.tasks.get(task_id)
+        if task is None:
+            return self.__fail(APIServerErrorCode.NO_TASK_ID)
+        self.server.stats.count()
+        created, cancelled = task
+        elapsed = time.time() - created
+        if cancelled:
+            status, sent = 4, 0
+        elif elapsed >= TASK_DURATION:
+            status, sent = 2, 100
+        elif elapsed >= TASK_DURATION / 4:
+            status, sent = 1, int(100 * elapsed / TASK_DURATION)
+        else:
+            status, sent = 0, 0
+        self.__reply(200, 'SUCCESS', {'task_id': task_id, 'status': status, 'total_count': 100,
+                                      'accept_count': sent, 'sent_count': sent, 'open_count': 0,
+                                      'dismiss_count': 0})
+
+    def __task_cancel(self, task_id):
+        task = self.server.tasks.get(task_id)
+        if task is None:
+            return self.__fail(APIServerErrorCode.NO_TASK_ID)
+        if task[1] or time.time() - task[0] >= TASK_DURATION:
+            return self.__fail(APIServerErrorCode.MESSAGE_CANCEL_FAILED)
+        self.server.stats.count()
+        self.server.tasks[task_id] = (task[0], True)
+        self.__reply(200, 'SUCCESS', {'task_id': task_id})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, secret, latency=None, failures=None, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, StubHandler)
+        self.secret = secret
+        self.latency = parse_latency(latency)
+        self.failures = parse_failures(failures)
+        self.verbose = verbose
+        self.stats = StubStats()
+        self.tasks = {}  # task_id -> (created, cancelled)
+
+    def add_task(self):
+        task_id = uuid.uuid4().hex
+        self.tasks[task_id] = (time.time(), False)
+        return task_id
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        """
+        serve in a daemon thread, return self
+        """
+        thread = threading.Thread(target=self.serve_forever, name='umeng_stub_server')
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--secret', default='secret', help='app_master_secret used to verify signs')
+    parser.add_argument('--latency', help='latency distribution, e.g. exp:0.02')
+    parser.add_argument('--fail', help='injected failures, e.g. 2026:0.01,4001:0.02,2028:0.01')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), args.secret, args.latency, args.fail, args.verbose)
+    print('serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'AsyncUMMessage',
+    'get_async_session',
+    'close_async_sessions',
+    'push_many_async',
+]
+
+import asyncio
+import time
+import weakref
+
+from . import log
+from .connect import UMMessage, MsgType
+from .transport import DEFAULT_POOL_MAXSIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+
+DEFAULT_CONCURRENCY = 100
+
+# aiohttp sessions are bound to the loop they were created on
+_sessions = weakref.WeakKeyDictionary()
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError('AsyncUMMessage requires aiohttp, run `pip install aiohttp`')
+    return aiohttp
+
+
+def get_async_session(limit=DEFAULT_POOL_MAXSIZE,
+                      connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                      read_timeout=DEFAULT_READ_TIMEOUT):
+    """
+    return the pooled aiohttp session of the running loop, options only apply when it is created
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        aiohttp = _import_aiohttp()
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_async_sessions():
+    loop = asyncio.get_running_loop()
+    session = _sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncUMMessage(UMMessage):
+    """
+    asyncio counterpart of UMMessage, payloads are built and signed by UMMessage
+    rate_limiter, retry_policy, dedup_cache, token_registry and metrics work as in push()
+    """
+    __slots__ = ('session', )
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param session=None,  # aiohttp.ClientSession，默认使用当前事件循环共享的连接池
+        other parameters are the same as UMMessage
+        """
+        self.session = kwargs.pop('session', None)
+        super(AsyncUMMessage, self).__init__(*args, **kwargs)
+
+    async def __acquire_rate_limit(self):
+        limiter = self.rate_limiter
+        if limiter is None:
+            return
+        deadline = None if limiter.timeout is None else time.time() + limiter.timeout
+        while True:
+            wait = limiter.try_acquire(self.app_key, self.type)
+            if wait <= 0:
+                return
+            if not limiter.blocking or (deadline is not None and time.time() + wait > deadline):
+                from .error_codes import UMRateLimitError
+
+                raise UMRateLimitError(self.app_key, self.type, wait)
+            await asyncio.sleep(wait)
+
+    async def __push_message(self, params, platform=None):
+        if not params:
+            return
+        if self.token_registry is None:
+            return await self.__push_message_retried(params, platform)
+
+        from .error_codes import UMPushError
+
+        try:
+            return await self.__push_message_retried(params, platform)
+        except UMPushError as e:
+            self.token_registry.record_error(params.get('device_tokens'), e.error_code)
+            raise
+
+    async def __push_message_retried(self, params, platform=None):
+        if self.retry_policy is None:
+            return await self.__push_message_once(params, platform)
+        return await self.retry_policy.run_async(lambda: self.__push_message_once(params, platform))
+
+    async def __push_message_once(self, params, platform=None):
+        metrics = self._metrics()
+        await self.__acquire_rate_limit()
+        post_body, sign = self._sign_body(lambda timestamp: self._encode_body(params, timestamp), platform, metrics)
+        session = self.session or get_async_session()
+        metrics.inflight(1)
+        started = time.perf_counter()
+        try:
+            async with session.post(self.url + '?sign='+sign, data=post_body) as r:
+                ret_text = await r.text()
+        finally:
+            metrics.inflight(-1)
+            metrics.observe('http', platform, time.perf_counter() - started)
+        return self._read_response(r.status, ret_text, params, platform, metrics)
+
+    async def __push_message_safe(self, params, platform=None):
+        try:
+            return await self.__push_message(params, platform)
+        except Exception as e:
+            log.failed(self, platform, e)
+
+    async def __build_params(self):
+        if self.type == MsgType.file_cast or (self.type == MsgType.customized_cast and self.alias_file):
+            # token and alias files are uploaded with the blocking transport, keep it off the event loop
+            return await asyncio.get_running_loop().run_in_executor(None, self._build_params_measured)
+        return self._build_params_measured()
+
+    async def push_async(self):
+        """
+        send android and ios requests concurrently, return (a_data, i_data)
+        """
+        cached = self._cached_result()
+        if cached is not None:
+            return cached
+        android_params, ios_params = await self.__build_params()
+        a_data, i_data = await asyncio.gather(self.__push_message_safe(android_params, 'android'),
+                                              self.__push_message_safe(ios_params, 'ios'))
+        self._remember_result(android_params, ios_params, a_data, i_data)
+        return a_data, i_data
+
+
+async def push_many_async(messages, concurrency=DEFAULT_CONCURRENCY):
+    """
+    push every AsyncUMMessage with at most `concurrency` pushes in flight
+    messages may be any iterable, it is consumed lazily by the workers
+    return a list of (a_data, i_data) in the order of messages
+    """
+    messages = enumerate(messages)
+    results = {}
+
+    async def _worker():
+        for index, message in messages:
+            results[index] = await message.push_async()
+
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    return [results[index] for index in range(len(results))]
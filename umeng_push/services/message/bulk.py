@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'BulkResult',
+    'BulkStats',
+    'bulk_push',
+]
+
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import log
+from .connect import UMMessage, UMNotification, DeviceType
+
+
+DEFAULT_CONCURRENCY = 16
+
+
+class BulkResult(object):
+
+    def __init__(self,
+                 index,  # 在输入中的序号
+                 device_token,
+                 device_type,
+                 data=None,  # MsgReturnData，发送失败时为 None
+                 ):
+        self.index = index
+        self.device_token = device_token
+        self.device_type = device_type
+        self.data = data
+
+    def __str__(self):
+        return "{} {} {}".format(self.index, self.device_token, self.data)
+
+
+class BulkStats(object):
+    """
+    counters of one bulk_push run, readable while it is running
+    """
+
+    def __init__(self):
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.peak_pending = 0
+        self.started = None
+        self.finished = None
+        self.peak_rss = None  # KB, ru_maxrss of the process when the run finished
+
+    @property
+    def completed(self):
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """
+        completed sends per second
+        """
+        elapsed = self.elapsed
+        return self.completed / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return "{} sent {} failed {:.1f}/s peak_pending {} peak_rss {}".format(
+            self.succeeded, self.failed, self.throughput, self.peak_pending, self.peak_rss)
+
+
+def _send_one(index, item, message_options):
+    device_token, device_type, payload = item[:3]
+    out_biz_no = item[3] if len(item) > 3 else uuid.uuid4().hex
+
+    message = UMMessage(out_biz_no=out_biz_no, **message_options)
+    message.set_unicast(device_token, device_type)
+    if isinstance(payload, UMNotification):
+        message.set_notification(payload)
+    else:
+        message.set_message(payload)
+
+    try:
+        a_data, i_data = message.push()
+    except Exception as e:
+        # push() only catches send errors, a bad payload must not stop the other items
+        log.failed(message, None, e)
+        return BulkResult(index, device_token, device_type)
+
+    if device_type == DeviceType.ios or device_type == DeviceType.ios.value:
+        data = i_data
+    else:
+        data = a_data
+    return BulkResult(index, device_token, device_type, data)
+
+
+def bulk_push(items,
+              concurrency=DEFAULT_CONCURRENCY,
+              max_pending=None,
+              stats=None,
+              **message_options):
+    """
+    send one unicast per item and yield BulkResult as the sends complete, not in input order
+    :param items,  # 可迭代对象，元素为 (device_token, device_type, UMNotification 或 message_body[, out_biz_no])
+    :param concurrency,  # 同时发送的请求数
+    :param max_pending,  # 已读取未完成的最大条数，默认 concurrency * 2，读取 items 会等待发送完成
+    :param stats,  # BulkStats，用于在外部读取吞吐量
+    :param message_options,  # 传给 UMMessage 的其它参数，如 description/app_key/rate_limiter
+    """
+    message_options.setdefault('description', None)
+    max_pending = max_pending or concurrency * 2
+    stats = stats if stats is not None else BulkStats()
+    stats.started = time.time()
+    pending = set()
+
+    def _collect(done):
+        for future in done:
+            result = future.result()
+            if result.data is not None and result.data.ret == 'SUCCESS':
+                stats.succeeded += 1
+            else:
+                stats.failed += 1
+            yield result
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='umeng_push_bulk') as executor:
+        for index, item in enumerate(items):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for result in _collect(done):
+                    yield result
+            pending.add(executor.submit(_send_one, index, item, message_options))
+            stats.submitted += 1
+            stats.peak_pending = max(stats.peak_pending, len(pending))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for result in _collect(done):
+                yield result
+
+    stats.finished = time.time()
+    try:
+        import resource
+        stats.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'AppClient',
+    'ClientRegistry',
+]
+
+import copy
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import log
+from .connect import UMMessage
+
+
+DEFAULT_REGISTRY_WORKERS = 16
+
+
+class AppClient(object):
+    """
+    credentials of one app and the objects shared by all of its messages:
+    connection pool, rate limiter, metrics, retry policy, dead token registry and dedup cache
+    """
+
+    def __init__(self,
+                 app_key,
+                 app_master_secret,
+                 transport=None,  # 默认为该 app 单独创建 UMTransport 连接池
+                 rate_limiter=None,  # 默认 RateLimiter()，广播/组播/文件播每分钟10次
+                 metrics=None,  # 默认 Metrics(labels={'app_key': app_key})
+                 retry_policy=None,
+                 token_registry=None,
+                 dedup_cache=None,
+                 weight=1,  # ClientRegistry 轮转到该 app 时连续发送的条数
+                 ):
+        from .metrics import Metrics
+        from .ratelimit import RateLimiter
+        from .transport import UMTransport
+
+        self.app_key = app_key
+        self.app_master_secret = app_master_secret
+        self.transport = transport if transport is not None else UMTransport()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else Metrics(labels={'app_key': app_key})
+        self.retry_policy = retry_policy
+        self.token_registry = token_registry
+        self.dedup_cache = dedup_cache
+        self.weight = weight
+
+    def message(self, out_biz_no, description, **kwargs):
+        """
+        UMMessage of this app, kwargs are the other UMMessage parameters
+        """
+        return UMMessage(out_biz_no, description,
+                         app_key=self.app_key,
+                         app_master_secret=self.app_master_secret,
+                         transport=self.transport,
+                         rate_limiter=self.rate_limiter,
+                         retry_policy=self.retry_policy,
+                         dedup_cache=self.dedup_cache,
+                         token_registry=self.token_registry,
+                         metrics=self.metrics,
+                         **kwargs)
+
+    def task_client(self):
+        from .tasks import UMTaskClient
+
+        return UMTaskClient(self.app_key, self.app_master_secret,
+                            transport=self.transport, retry_policy=self.retry_policy)
+
+    def close(self):
+        self.transport.close()
+
+
+class _Item(object):
+    __slots__ = ('message', 'future', 'sender', 'params', 'pending', 'results')
+
+    def __init__(self, message, future):
+        self.message = message
+        self.future = future
+        self.sender = None  # copy of message sent with the registry's non blocking limiter
+        self.params = None  # (android_params, ios_params) once built
+        self.pending = None  # [android_params, ios_params] not sent yet
+        self.results = [None, None]
+
+
+class _AppQueue(object):
+    """
+    messages of one app waiting in the registry, one lane per message type
+    a lane waiting for a rate limit token does not hold back the other lanes
+    """
+    __slots__ = ('client', 'lanes', 'not_before', 'credit', 'count')
+
+    def __init__(self, client):
+        self.client = client
+        self.lanes = OrderedDict()  # MsgType -> deque of _Item
+        self.not_before = {}  # MsgType -> time the rate limiter allows the next send
+        self.credit = client.weight
+        self.count = 0
+
+    def add(self, item, first=False):
+        msg_type = item.message.type
+        lane = self.lanes.get(msg_type)
+        if lane is None:
+            lane = self.lanes[msg_type] = deque()
+        if first:
+            lane.appendleft(item)
+        else:
+            lane.append(item)
+        self.count += 1
+
+    def defer(self, item, until):
+        # a rate limited item keeps its place at the head of its lane
+        self.add(item, first=True)
+        self.not_before[item.message.type] = max(until, self.not_before.get(item.message.type, 0))
+
+    def take(self, now):
+        """
+        return the next _Item whose type is not waiting for the rate limiter, or the seconds until one is
+        """
+        wait = None
+        for msg_type in list(self.lanes):
+            not_before = self.not_before.get(msg_type, 0)
+            if not_before > now:
+                wait = not_before - now if wait is None else min(wait, not_before - now)
+                continue
+            self.not_before.pop(msg_type, None)
+            lane = self.lanes[msg_type]
+            item = lane.popleft()
+            # the next take starts with the following type, types are served in turn
+            del self.lanes[msg_type]
+            if lane:
+                self.lanes[msg_type] = lane
+            self.count -= 1
+            return item
+        return wait
+
+
+class ClientRegistry(object):
+    """
+    AppClient per app_key and a scheduler sending the messages submitted for all apps
+    apps with waiting messages are served in turn, `weight` messages each, so a long backlog of one app
+    only delays the other apps by one turn
+    every platform request and retry takes a rate limit token, a message whose type is out of tokens goes back
+    to the head of its lane until the limiter allows the next request, without holding a worker
+    """
+
+    def __init__(self, workers=DEFAULT_REGISTRY_WORKERS):
+        self.clients = {}
+        self.limiters = {}  # app_key -> non blocking view of the app's RateLimiter, same buckets
+        self.queues = {}  # app_key -> _AppQueue
+        self.ready = deque()  # app_keys with waiting messages, in serving order
+        self.condition = threading.Condition()
+        self.slots = threading.BoundedSemaphore(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='umeng_push_registry')
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run, name='umeng_push_registry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register(self, app_key, app_master_secret=None, **options):
+        """
+        add an app, options are the AppClient parameters
+        an AppClient may be passed instead of app_key
+        """
+        client = app_key if isinstance(app_key, AppClient) else AppClient(app_key, app_master_secret, **options)
+        limiter = copy.copy(client.rate_limiter)
+        limiter.blocking = False
+        with self.condition:
+            self.clients[client.app_key] = client
+            self.limiters[client.app_key] = limiter
+        return client
+
+    def unregister(self, app_key):
+        with self.condition:
+            if app_key in self.queues:
+                raise ValueError('app {} has messages waiting'.format(app_key))
+            client = self.clients.pop(app_key)
+            self.limiters.pop(app_key, None)
+        client.close()
+
+    def get(self, app_key):
+        return self.clients[app_key]
+
+    def __contains__(self, app_key):
+        return app_key in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def secret(self, app_key):
+        """
+        app_master_secret of app_key, usable as the secrets of outbox.Dispatcher
+        """
+        return self.clients[app_key].app_master_secret
+
+    def message(self, app_key, out_biz_no, description, **kwargs):
+        return self.clients[app_key].message(out_biz_no, description, **kwargs)
+
+    def submit(self, message):
+        """
+        queue message for its app, the registry takes the rate limit token instead of message.push()
+        :return concurrent.futures.Future of (a_data, i_data)
+        """
+        if self.closed:
+            raise RuntimeError('registry is closed')
+        item = _Item(message, Future())
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('registry is closed')
+            self.__queue(message.app_key).add(item)
+            self.condition.notify()
+        return item.future
+
+    def __queue(self, app_key):
+        # called with self.condition held
+        queue = self.queues.get(app_key)
+        if queue is None:
+            queue = self.queues[app_key] = _AppQueue(self.clients[app_key])
+            self.ready.append(app_key)
+        return queue
+
+    def push(self, message):
+        return self.submit(message).result()
+
+    def __next(self, now):
+        """
+        return the next _Item in turn, or the seconds until one may be sent, None when empty
+        """
+        wait = None
+        for _ in range(len(self.ready)):
+            app_key = self.ready[0]
+            queue = self.queues[app_key]
+            item = queue.take(now)
+            if isinstance(item, _Item):
+                queue.credit -= 1
+                if not queue.count:
+                    self.ready.popleft()
+                    del self.queues[app_key]
+                elif queue.credit <= 0:
+                    queue.credit = queue.client.weight
+                    self.ready.rotate(-1)
+                return item
+            # every type of this app is rate limited, give the turn to the next app
+            queue.credit = queue.client.weight
+            self.ready.rotate(-1)
+            if item is not None:
+                wait = item if wait is None else min(wait, item)
+        return wait
+
+    def __run(self):
+        condition = self.condition
+        while True:
+            self.slots.acquire()
+            with condition:
+                while True:
+                    if self.closed and not self.queues:
+                        self.slots.release()
+                        return
+                    item = self.__next(time.time())
+                    if isinstance(item, _Item):
+                        break
+                    condition.wait(item)
+            self.executor.submit(self.__send, item)
+
+    def __send(self, item):
+        try:
+            self.__send_item(item)
+        except Exception as e:
+            item.future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    def __send_item(self, item):
+        from .error_codes import UMRateLimitError
+
+        if item.sender is None:
+            if not item.future.set_running_or_notify_cancel():
+                return
+            cached = item.message._cached_result()
+            if cached is not None:
+                item.future.set_result(cached)
+                return
+            # the caller's message is left as it was submitted
+            item.sender = copy.copy(item.message)
+            item.sender.rate_limiter = self.limiters[item.message.app_key]
+            item.params = item.sender._build_params_measured()
+            item.pending = list(item.params)
+
+        sender = item.sender
+        for index, platform in enumerate(('android', 'ios')):
+            params = item.pending[index]
+            if not params:
+                continue
+            try:
+                item.results[index] = sender._push_platform(params, platform)
+            except UMRateLimitError as e:
+                # the platforms already sent are not sent again
+                self.__defer(item, e.wait)
+                return
+            except Exception as e:
+                log.failed(sender, platform, e)
+            item.pending[index] = None
+
+        a_data, i_data = item.results
+        sender._remember_result(item.params[0], item.params[1], a_data, i_data)
+        item.future.set_result((a_data, i_data))
+
+    def __defer(self, item, wait):
+        with self.condition:
+            # a blocking limiter with a timeout does not tell how long to wait
+            self.__queue(item.message.app_key).defer(item, time.time() + (wait if wait is not None else 1.0))
+            self.condition.notify()
+
+    def pending(self):
+        """
+        {app_key: number of waiting messages}
+        """
+        with self.condition:
+            return {app_key: queue.count for app_key, queue in self.queues.items()}
+
+    def render_prometheus(self):
+        """
+        metrics of every app in one exposition, each family listed once
+        """
+        families = OrderedDict()
+        for client in list(self.clients.values()):
+            family = None
+            for line in client.metrics.render_prometheus().splitlines():
+                if line.startswith('# HELP '):
+                    family = families.setdefault(line.split()[2], [line])
+                elif line.startswith('# TYPE '):
+                    if len(family) == 1:
+                        family.append(line)
+                else:
+                    family.append(line)
+        return ''.join('\n'.join(lines) + '\n' for lines in families.values())
+
+    def close(self, wait=True):
+        """
+        send the waiting messages, stop the scheduler and close every app's connection pool
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if wait:
+            self.thread.join()
+        self.executor.shutdown(wait=wait)
+        for client in list(self.clients.values()):
+            client.close()
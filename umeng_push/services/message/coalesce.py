@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'Coalescer',
+]
+
+import copy
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import codec
+from . import log
+from .connect import MsgType, DeviceSet, MAX_DEVICE_TOKENS
+
+
+DEFAULT_WINDOW = 0.02  # 秒
+DEFAULT_COALESCER_WORKERS = 8
+
+# UMMessage options that must be the same object for two messages to be sent together
+_OPTIONS = ('transport', 'rate_limiter', 'retry_policy', 'dedup_cache', 'token_registry', 'metrics')
+
+
+class _Group(object):
+    __slots__ = ('deadline', 'entries', 'counts')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.entries = []  # (message, platform index, token, future)
+        self.counts = [0, 0]
+
+
+class Coalescer(object):
+    """
+    buffers unicasts for `window` seconds and sends the ones with the same payload as one listcast per platform
+    the payload fingerprint covers credentials, notification or message body, policy, production_mode and options
+    submit() returns a Future of (a_data, i_data) like push(), an error of the listcast is the error of every caller
+    a group of one message is pushed as is, under its own out_biz_no
+    a merged listcast is sent under an md5 of the out_biz_nos of its callers, the server cannot deduplicate
+    a caller that resubmits one of them later, its token may receive the message twice
+    """
+
+    def __init__(self,
+                 window=DEFAULT_WINDOW,  # 秒，第一条消息最多等待的时间
+                 max_tokens=MAX_DEVICE_TOKENS,  # 任一平台的 token 达到该数量时立即发送
+                 workers=DEFAULT_COALESCER_WORKERS,  # 同时发送的请求数
+                 ):
+        self.window = window
+        self.max_tokens = max_tokens
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='umeng_push_coalesce')
+        self.condition = threading.Condition()
+        self.groups = OrderedDict()  # fingerprint -> _Group, oldest first
+        self.closed = False
+        self.submitted = 0  # submit() 收到的消息数
+        self.pushes = 0  # 实际调用 push() 的次数，每次每个平台最多一个请求
+        self.thread = threading.Thread(target=self.__run, name='umeng_push_coalescer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __fingerprint(self, message):
+        notification = message.notification
+        fields = [message.app_key, message.app_master_secret, message.production_mode,
+                  message.description, message.thirdparty_id, message.url,
+                  message.display_type.value if message.display_type is not None else None,
+                  message.custom, message.content,
+                  notification._to_row() if notification is not None else None,
+                  getattr(message, 'start_time', None),
+                  getattr(message, 'expire_time', None),
+                  getattr(message, 'max_send_num', None),
+                  [id(getattr(message, name)) for name in _OPTIONS]]
+        return codec.dumps(fields)
+
+    def submit(self, message):
+        """
+        queue message for sending, messages other than unicasts of one token are pushed on their own
+        :return concurrent.futures.Future of (a_data, i_data)
+        """
+        fingerprint = None
+        # a unicast whose device type is unknown has no token, it is pushed on its own like any other message
+        if (message.type == MsgType.unicast and isinstance(message.devices, DeviceSet) and
+                len(message.devices.android) + len(message.devices.ios) == 1):
+            try:
+                fingerprint = self.__fingerprint(message)
+            except TypeError:
+                # custom or extra values the codec cannot encode are never merged
+                pass
+
+        # closed is checked and the message queued under the lock, close() cannot stop the sender in between
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('coalescer is closed')
+            self.submitted += 1
+            if fingerprint is None:
+                return self.executor.submit(self.__push, message)
+
+            index = 0 if message.devices.android else 1
+            token = (message.devices.android or message.devices.ios)[0]
+            future = Future()
+            group = self.groups.get(fingerprint)
+            if group is None:
+                group = self.groups[fingerprint] = _Group(time.time() + self.window)
+                self.condition.notify()
+            group.entries.append((message, index, token, future))
+            group.counts[index] += 1
+            if group.counts[index] >= self.max_tokens:
+                self.executor.submit(self.__send, self.groups.pop(fingerprint))
+        return future
+
+    def __push(self, message):
+        with self.condition:
+            self.pushes += 1
+        return message.push()
+
+    def __send(self, group):
+        # callers may have cancelled their future while it was buffered
+        entries = [entry for entry in group.entries if entry[3].set_running_or_notify_cancel()]
+        # members already sent under their own out_biz_no are answered from their dedup_cache, not sent again
+        entries = [entry for entry in entries if not self.__answer_cached(entry)]
+        if not entries:
+            return
+        if len(entries) == 1:
+            message, _, _, future = entries[0]
+            try:
+                future.set_result(self.__push(message))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        first = entries[0][0]
+        listcast = copy.copy(first)
+        listcast.type = MsgType.list_cast
+        listcast.devices = DeviceSet()
+        for message, index, token, _ in entries:
+            (listcast.devices.android, listcast.devices.ios)[index].append(token)
+        # only a resend of this exact batch is deduplicated by the server, see the class docstring
+        out_biz_nos = ','.join(str(message.out_biz_no) for message, _, _, _ in entries)
+        listcast.out_biz_no = hashlib.md5(out_biz_nos.encode()).hexdigest()
+        # results are remembered under the key of every member instead of the md5
+        listcast.dedup_cache = None
+
+        try:
+            a_data, i_data = self.__push(listcast)
+        except Exception as e:
+            log.failed(listcast, None, e)
+            for _, _, _, future in entries:
+                future.set_exception(e)
+            return
+        for message, index, _, future in entries:
+            if index:
+                message._remember_result(None, listcast.ios_params, None, i_data)
+                future.set_result((None, i_data))
+            else:
+                message._remember_result(listcast.android_params, None, a_data, None)
+                future.set_result((a_data, None))
+
+    def __answer_cached(self, entry):
+        message, _, _, future = entry
+        try:
+            cached = message._cached_result()
+        except Exception as e:
+            future.set_exception(e)
+            return True
+        if cached is None:
+            return False
+        future.set_result(cached)
+        return True
+
+    def __run(self):
+        condition = self.condition
+        while True:
+            with condition:
+                while not self.groups and not self.closed:
+                    condition.wait()
+                if not self.groups:
+                    return
+                fingerprint, group = next(iter(self.groups.items()))
+                delay = group.deadline - time.time()
+                if delay > 0 and not self.closed:
+                    condition.wait(delay)
+                    continue
+                del self.groups[fingerprint]
+            self.executor.submit(self.__send, group)
+
+    def flush(self):
+        """
+        send every buffered group now without waiting for its window
+        """
+        with self.condition:
+            for group in self.groups.values():
+                self.executor.submit(self.__send, group)
+            self.groups.clear()
+
+    def close(self, wait=True):
+        """
+        send the buffered groups and stop, submit() raises afterwards
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=wait)
+
+    def stats(self):
+        return {'submitted': self.submitted, 'pushes': self.pushes, 'pending': sum(
+            len(group.entries) for group in list(self.groups.values()))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
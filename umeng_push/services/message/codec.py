@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'dumps',
+    'loads',
+    'set_json_backend',
+    'get_json_backend',
+]
+
+import json
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+def _orjson_backend():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+def _ujson_backend():
+    import ujson
+    return (lambda obj: ujson.dumps(obj, ensure_ascii=False).encode()), ujson.loads
+
+
+_BACKENDS = {
+    'json': lambda: (_json_dumps, json.loads),
+    'orjson': _orjson_backend,
+    'ujson': _ujson_backend,
+}
+
+_backend_name = None
+_dumps = None
+_loads = None
+
+
+def set_json_backend(name=None):
+    """
+    select the json encoder used for request bodies, 'orjson', 'ujson' or 'json'
+    None picks the fastest one installed
+    """
+    global _backend_name, _dumps, _loads
+    names = [name] if name else ['orjson', 'ujson', 'json']
+    for candidate in names:
+        try:
+            _dumps, _loads = _BACKENDS[candidate]()
+        except ImportError:
+            if name:
+                raise
+            continue
+        _backend_name = candidate
+        return
+
+
+def get_json_backend():
+    return _backend_name
+
+
+def dumps(obj):
+    """
+    encode obj to json bytes, the exact buffer that is signed and sent
+    """
+    return _dumps(obj)
+
+
+def loads(data):
+    return _loads(data)
+
+
+set_json_backend()
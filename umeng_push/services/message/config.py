@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'UMConfig',
+    'set_config',
+    'set_resolvers',
+    'get_credentials',
+    'resolve_credentials',
+    'django_resolver',
+    'env_resolver',
+]
+
+import os
+
+
+class UMConfig(object):
+
+    def __init__(self, app_key=None, app_master_secret=None):
+        self.app_key = app_key
+        self.app_master_secret = app_master_secret
+
+
+_config = None
+
+
+def set_config(config=None, **kwargs):
+    """
+    set explicit credentials, they take precedence over every resolver
+    set_config(UMConfig(...)) or set_config(app_key=..., app_master_secret=...), set_config(None) clears them
+    """
+    global _config
+    _config = config if config is not None or not kwargs else UMConfig(**kwargs)
+
+
+def django_resolver():
+    """
+    UMENG_APP_KEY/UMENG_APP_MASTER_SECRET from django settings, None when django is missing or not configured
+    """
+    try:
+        from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
+    except ImportError:
+        return None
+    try:
+        return UMConfig(getattr(settings, 'UMENG_APP_KEY', None),
+                        getattr(settings, 'UMENG_APP_MASTER_SECRET', None))
+    except ImproperlyConfigured:
+        return None
+
+
+def env_resolver():
+    """
+    UMENG_APP_KEY/UMENG_APP_MASTER_SECRET environment variables
+    """
+    return UMConfig(os.environ.get('UMENG_APP_KEY'), os.environ.get('UMENG_APP_MASTER_SECRET'))
+
+
+_resolvers = [django_resolver, env_resolver]
+
+
+def set_resolvers(resolvers):
+    """
+    replace the resolvers consulted in order after the explicit config
+    a resolver is a callable returning a UMConfig or None
+    """
+    global _resolvers
+    _resolvers = list(resolvers)
+
+
+def _configs():
+    # resolvers are only called until both values are found
+    yield _config
+    for resolver in _resolvers:
+        yield resolver()
+
+
+def get_credentials():
+    """
+    resolve (app_key, app_master_secret) now, each value is None when nothing provides it
+    """
+    app_key, app_master_secret = None, None
+    for config in _configs():
+        if config is None:
+            continue
+        if app_key is None:
+            app_key = config.app_key
+        if app_master_secret is None:
+            app_master_secret = config.app_master_secret
+        if app_key is not None and app_master_secret is not None:
+            break
+    return app_key, app_master_secret
+
+
+def resolve_credentials(app_key=None, app_master_secret=None):
+    """
+    the given values, each one that is None resolved by get_credentials()
+    raise ValueError when either is still missing
+    """
+    if app_key is None or app_master_secret is None:
+        default_app_key, default_app_master_secret = get_credentials()
+        app_key = default_app_key if app_key is None else app_key
+        app_master_secret = default_app_master_secret if app_master_secret is None else app_master_secret
+    if app_key is None or app_master_secret is None:
+        raise ValueError('APP_KEY or APP_MASTER_SECRET is None')
+    return app_key, app_master_secret
@@ -9,25 +9,77 @@ __all__ = [
     'UMNotification',
 ]
 
-from django.conf import settings
-
-try:
-    APP_KEY = getattr(settings, 'UMENG_APP_KEY', None)
-    APP_MASTER_SECRET = getattr(settings, 'UMENG_APP_MASTER_SECRET', None)
-except:
-    APP_KEY = ''
-    APP_MASTER_SECRET = ''
-
-
+import os
+import sys
 import time
+import threading
 
 import hashlib
 import json
-import requests
-import logging
 
 
 from enum import Enum
+from itertools import compress, repeat
+
+from . import codec
+from . import log
+from .config import get_credentials, resolve_credentials
+from .metrics import NULL_METRICS
+
+
+PLATFORM_EXECUTOR_WORKERS = 8
+CHUNK_EXECUTOR_WORKERS = 8
+
+# device_tokens 个数上限，超过时服务器返回 DEVICE_TOKENS_GREATER_THAN_FIFTY
+MAX_DEVICE_TOKENS = 50
+
+# alias 个数上限，超过时服务器返回 ALIAS_GREATER_THAN_FIFTY
+MAX_ALIASES = 50
+
+# filecast 上传内容超过该字节数时写入临时文件
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+# 上传时每次从临时文件读取的字节数
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# to_dict/to_bytes 格式版本，from_dict/from_bytes 不接受其它版本
+SERIAL_VERSION = 1
+
+
+def __getattr__(name):
+    # APP_KEY/APP_MASTER_SECRET used to be read from django settings at import time
+    if name == 'APP_KEY':
+        return get_credentials()[0]
+    if name == 'APP_MASTER_SECRET':
+        return get_credentials()[1]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _get_transport():
+    # requests is only imported by the first send
+    from .transport import get_transport
+
+    return get_transport()
+
+
+_platform_executor = None
+_platform_executor_pid = None
+_platform_executor_lock = threading.Lock()
+
+
+def _get_platform_executor():
+    """
+    small per-process pool used by UMMessage.push(concurrent=True)
+    """
+    global _platform_executor, _platform_executor_pid
+    if _platform_executor is None or _platform_executor_pid != os.getpid():
+        with _platform_executor_lock:
+            if _platform_executor is None or _platform_executor_pid != os.getpid():
+                from concurrent.futures import ThreadPoolExecutor
+
+                _platform_executor = ThreadPoolExecutor(max_workers=PLATFORM_EXECUTOR_WORKERS,
+                                                        thread_name_prefix='umeng_push')
+                _platform_executor_pid = os.getpid()
+    return _platform_executor
 
 
 class DeviceType(Enum):
@@ -56,23 +108,180 @@ class AfterOpenType(Enum):
     go_custom = 'go_custom'
 
 
+class _UploadBody(object):
+    """
+    upload request body of a token file, spooled to disk only when it grows over UPLOAD_SPOOL_SIZE
+    it is posted as an iterable with a length, requests would write a file object to disk to get its fileno
+    """
+
+    def __init__(self, url, app_key, app_master_secret):
+        import tempfile
+
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        self.md5 = hashlib.md5('POST{}'.format(url).encode())
+        self.app_master_secret = app_master_secret
+        self.count = 0
+        self.size = 0
+        self.__write('{{"appkey": {}, "timestamp": {}, "content": "'.format(
+            json.dumps(app_key), int(time.time() * 1000)))
+
+    def __write(self, s):
+        data = s.encode()
+        self.md5.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def add(self, token):
+        # tokens are separated by an escaped newline inside the json string, integer aliases are sent as text
+        self.__write('{}{}'.format('\\n' if self.count else '', json.dumps(str(token))[1:-1]))
+        self.count += 1
+
+    def finish(self):
+        """
+        close the json document and return the sign
+        """
+        self.__write('"}')
+        self.md5.update(self.app_master_secret.encode())
+        return self.md5.hexdigest()
+
+    def __len__(self):
+        # sent as Content-Length instead of a chunked body
+        return self.size
+
+    def __iter__(self):
+        # every iteration reads from the start, a retried upload sends the whole body again
+        self.file.seek(0)
+        return iter(lambda: self.file.read(UPLOAD_CHUNK_SIZE), b'')
+
+    def close(self):
+        self.file.close()
+
+
+def _check_version(version):
+    if version != SERIAL_VERSION:
+        raise ValueError('unsupported serialization version {!r}'.format(version))
+
+
+def _is_ndarray(value):
+    # numpy is optional, an array can only exist once something else imported it
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+class DeviceColumns(object):
+    """
+    parallel token and device type sequences read lazily, e.g. two columns of a database cursor
+    iterating yields (token, type) pairs, lazy sources can only be read once
+    """
+    __slots__ = ('tokens', 'types')
+
+    def __init__(self, tokens, types):
+        self.tokens = tokens
+        self.types = types
+
+    def __iter__(self):
+        return zip(self.tokens, self.types)
+
+
+class DeviceSet(object):
+    """
+    device tokens partitioned by platform as they are added
+    iterating yields (token, DeviceType) like the list given to set_listcast
+    """
+    __slots__ = ('android', 'ios')
+
+    # device type, or its value, to the index in (android, ios)
+    _PLATFORMS = {DeviceType.android: 0, DeviceType.android.value: 0,
+                  DeviceType.ios: 1, DeviceType.ios.value: 1}
+
+    def __init__(self, devices=()):
+        self.android = []
+        self.ios = []
+        self.extend(devices)
+
+    def add(self, token, device_type):
+        index = self._PLATFORMS.get(device_type)
+        if index is not None:
+            (self.android, self.ios)[index].append(token)
+
+    def extend(self, devices):
+        lists = (self.android, self.ios)
+        platforms = self._PLATFORMS
+        for token, device_type in devices:
+            index = platforms.get(device_type)
+            if index is not None:
+                lists[index].append(token)
+
+    def extend_columns(self, tokens, types):
+        """
+        add parallel sequences of tokens and device types without pairing them up
+        :param tokens,  # token 序列，list/NumPy 数组，或生成器等可迭代对象
+        :param types,  # 与 tokens 等长的 DeviceType 或其 value，支持 array.array/NumPy 整数数组
+        """
+        if _is_ndarray(types) and types.dtype.kind in 'iub':
+            # one vectorized comparison per platform
+            android_mask, ios_mask = types == DeviceType.android.value, types == DeviceType.ios.value
+            if _is_ndarray(tokens):
+                self.android.extend(tokens[android_mask].tolist())
+                self.ios.extend(tokens[ios_mask].tolist())
+            else:
+                if not hasattr(tokens, '__len__'):
+                    # a lazy iterable would be used up by the first platform
+                    tokens = list(tokens)
+                self.android.extend(compress(tokens, android_mask.tolist()))
+                self.ios.extend(compress(tokens, ios_mask.tolist()))
+        elif hasattr(tokens, '__len__') and hasattr(types, '__len__'):
+            # sequences can be read twice, one C level pass per platform
+            # unknown types map to -1, int.__eq__(None) would be NotImplemented which is truthy
+            platforms = self._PLATFORMS
+            self.android.extend(compress(tokens, map((0).__eq__, map(platforms.get, types, repeat(-1)))))
+            self.ios.extend(compress(tokens, map((1).__eq__, map(platforms.get, types, repeat(-1)))))
+        else:
+            lists = (self.android, self.ios)
+            platforms = self._PLATFORMS
+            for token, device_type in zip(tokens, types):
+                index = platforms.get(device_type)
+                if index is not None:
+                    lists[index].append(token)
+        return self
+
+    def __iter__(self):
+        for token in self.android:
+            yield token, DeviceType.android
+        for token in self.ios:
+            yield token, DeviceType.ios
+
+    def __len__(self):
+        return len(self.android) + len(self.ios)
+
+
 class MsgReturnData(object):
+    __slots__ = ('ret', 'thirdparty_id', 'msg_id', 'error_code', 'task_id')
 
     def __init__(self,
                  ret,
                  thirdparty_id,
                  msg_id=None,
-                 error_code=None):
+                 error_code=None,
+                 task_id=None,  # broadcast/groupcast/filecast 等任务类消息返回，用于 tasks.UMTaskClient
+                 ):
         self.ret = ret
         self.thirdparty_id = thirdparty_id
         self.msg_id = msg_id
         self.error_code = error_code
+        self.task_id = task_id
 
     def __str__(self):
         return "{} {} {} {}".format(self.ret, self.thirdparty_id, self.msg_id, self.error_code)
 
+    def to_dict(self):
+        return {'ret': self.ret, 'thirdparty_id': self.thirdparty_id, 'msg_id': self.msg_id,
+                'error_code': self.error_code, 'task_id': self.task_id}
+
 
 class UMNotification(object):
+    __slots__ = ('ticker', 'title', 'text', 'icon', 'large_icon', 'img', 'sound', 'builder_id',
+                 'play_vibrate', 'play_lights', 'play_sound', 'extra', 'after_open', 'url', 'activity', 'custom')
 
     def __init__(self,
                  ticker,  # 通知栏提示文字
@@ -141,6 +350,61 @@ class UMNotification(object):
 
         return notif
 
+    def to_dict(self):
+        """
+        versioned dict of the attributes that are set, after_open as its value
+        """
+        data = {'version': SERIAL_VERSION}
+        for key in self.__slots__:
+            if hasattr(self, key):
+                data[key] = getattr(self, key)
+        data['after_open'] = self.after_open.value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        _check_version(data.get('version'))
+        notification = cls(data['ticker'], data['title'], data['text'])
+        for key in cls.__slots__:
+            if key in data:
+                setattr(notification, key, data[key])
+        notification.after_open = AfterOpenType(data['after_open'])
+        return notification
+
+    def _to_row(self):
+        # [bit mask of the attributes that are set, their values in __slots__ order]
+        mask = 0
+        row = [0]
+        for bit, key in enumerate(self.__slots__):
+            if hasattr(self, key):
+                mask |= 1 << bit
+                value = getattr(self, key)
+                row.append(value.value if key == 'after_open' else value)
+        row[0] = mask
+        return row
+
+    @classmethod
+    def _from_row(cls, row):
+        notification = cls.__new__(cls)
+        mask = row[0]
+        values = iter(row[1:])
+        for bit, key in enumerate(cls.__slots__):
+            if mask >> bit & 1:
+                setattr(notification, key, next(values))
+        notification.after_open = AfterOpenType(notification.after_open)
+        return notification
+
+    def to_bytes(self):
+        """
+        compact encoding, a version byte followed by the attribute values without their names
+        """
+        return bytes((SERIAL_VERSION, )) + codec.dumps(self._to_row())
+
+    @classmethod
+    def from_bytes(cls, data):
+        _check_version(data[0])
+        return cls._from_row(codec.loads(data[1:]))
+
     def set_go_app(self):
         self.after_open = AfterOpenType.go_app
 
@@ -163,9 +427,10 @@ class UMNotification(object):
             self.custom = custom
 
     def __str__(self):
-        attrs = vars(self)
+        # url/activity/custom are only set by the matching set_go_* call
+        attrs = [(key, getattr(self, key)) for key in self.__slots__ if hasattr(self, key)]
         data = {}
-        for key, value in list(attrs.items()):
+        for key, value in attrs:
             if value == AfterOpenType.go_app:
                 value = 'AfterOpenType.go_app'
             elif value == AfterOpenType.go_activity:
@@ -179,22 +444,38 @@ class UMNotification(object):
 
 
 class UMMessage(object):
+    __slots__ = ('thirdparty_id', 'out_biz_no', 'app_key', 'app_master_secret', 'devices', 'type', 'display_type',
+                 'custom', 'content', 'description', 'production_mode', 'url', 'upload_url',
+                 'android_params', 'ios_params', 'notification', 'start_time', 'expire_time', 'max_send_num',
+                 'filter', 'alias_type', 'aliases', 'alias_file', 'device_type',
+                 'transport', 'rate_limiter', 'retry_policy', 'dedup_cache', 'token_registry', 'metrics')
 
     def __init__(self,
                  out_biz_no,  # 开发者对消息的唯一标识，服务器会根据这个标识避免重复发送。
                  description,  # 发送消息描述，建议填写。
                  production_mode=False,
                  thirdparty_id=None,  # 开发者自定义消息标识ID
-                 app_key=APP_KEY,
-                 app_master_secret=APP_MASTER_SECRET,
+                 app_key=None,  # 默认由 config.get_credentials() 获取
+                 app_master_secret=None,
+                 transport=None,  # 默认使用进程内共享的连接池 transport.get_transport()
+                 rate_limiter=None,  # ratelimit.RateLimiter，None 表示不限速
+                 retry_policy=None,  # retry.RetryPolicy，None 表示不重试
+                 dedup_cache=None,  # dedup.DedupCache，None 表示不在本地去重
+                 token_registry=None,  # tokens.DeadTokenRegistry，发送前过滤失效和重复的 token
+                 metrics=None,  # metrics.Metrics，None 表示不统计
                  ):
         """
         :param out_biz_no,  # 开发者对消息的唯一标识，服务器会根据这个标识避免重复发送。
         :param description,  # 发送消息描述，建议填写。
         :param thirdparty_id=None,  # 开发者自定义消息标识ID
+        :param transport=None,  # UMTransport，默认使用进程内共享的连接池
+        :param rate_limiter=None,  # RateLimiter，发送前按 app_key 和消息类型取令牌
+        :param retry_policy=None,  # RetryPolicy，临时性错误时刷新 timestamp 和 sign 后重试
+        :param dedup_cache=None,  # DedupCache，最近成功发送过的 out_biz_no 直接返回缓存的结果
+        :param token_registry=None,  # DeadTokenRegistry，过滤失效的 token，并记录服务器返回失效的 token
+        :param metrics=None,  # Metrics，记录各阶段耗时、HTTP 状态码、错误码和进行中的请求数
         """
-        if app_key is None or app_master_secret is None:
-            raise ValueError('APP_KEY or APP_MASTER_SECRET is None')
+        app_key, app_master_secret = resolve_credentials(app_key, app_master_secret)
 
         self.thirdparty_id = thirdparty_id
         self.out_biz_no = out_biz_no
@@ -208,9 +489,21 @@ class UMMessage(object):
         self.description = description
         self.production_mode = production_mode
         self.url = 'http://msg.umeng.com/api/send'
+        self.upload_url = 'http://msg.umeng.com/upload'
         self.android_params = None
         self.ios_params = None
         self.notification = None
+        self.filter = None
+        self.alias_type = None
+        self.aliases = None
+        self.alias_file = False
+        self.device_type = None  # 广播/组播/自定义播只发送到该平台，None 表示两个平台
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.dedup_cache = dedup_cache
+        self.token_registry = token_registry
+        self.metrics = metrics
 
     # @property
     # def android_params(self):
@@ -232,18 +525,219 @@ class UMMessage(object):
     # def ios_params(self, ios_params):
     #     self.__ios_params = ios_params
 
+    def __device_lists(self):
+        # lazy devices are read once here and kept as a DeviceSet
+        if not isinstance(self.devices, DeviceSet):
+            self.devices = DeviceSet(self.devices)
+        return self.devices.android, self.devices.ios
+
+    def __alias_list(self):
+        # lazy aliases of a customizedcast file are read once here
+        if self.aliases is not None and not isinstance(self.aliases, list):
+            self.aliases = list(self.aliases)
+        return self.aliases
+
+    def __set_device_lists(self, android_device_token, ios_device_token):
+        if android_device_token or ios_device_token:
+            self.devices = DeviceSet()
+            self.devices.android = android_device_token
+            self.devices.ios = ios_device_token
+
+    def to_dict(self):
+        """
+        versioned dict of the message including notification, policy and devices
+        app_master_secret and the transport/rate_limiter/... options are not included, pass them to from_dict
+        """
+        android_device_token, ios_device_token = self.__device_lists()
+        return {'version': SERIAL_VERSION,
+                'out_biz_no': self.out_biz_no,
+                'description': self.description,
+                'production_mode': self.production_mode,
+                'thirdparty_id': self.thirdparty_id,
+                'app_key': self.app_key,
+                'type': self.type.value if self.type is not None else None,
+                'display_type': self.display_type.value if self.display_type is not None else None,
+                'custom': self.custom,
+                'content': self.content,
+                'notification': self.notification.to_dict() if self.notification is not None else None,
+                'policy': {item: getattr(self, item, None)
+                           for item in ('start_time', 'expire_time', 'max_send_num')},
+                'url': self.url,
+                'upload_url': self.upload_url,
+                'devices': {'android': list(android_device_token), 'ios': list(ios_device_token)},
+                'filter': self.filter,
+                'alias_type': self.alias_type,
+                'aliases': self.__alias_list(),
+                'alias_file': self.alias_file,
+                'device_type': self.device_type.value if self.device_type is not None else None,
+                }
+
+    @classmethod
+    def from_dict(cls, data, app_master_secret=None, **options):
+        """
+        :param app_master_secret=None,  # 默认由 config.get_credentials() 获取
+        :param options,  # 其它 UMMessage 参数，如 transport/rate_limiter/retry_policy
+        """
+        _check_version(data.get('version'))
+        message = cls(data['out_biz_no'], data['description'],
+                      production_mode=data['production_mode'],
+                      thirdparty_id=data['thirdparty_id'],
+                      app_key=data['app_key'],
+                      app_master_secret=app_master_secret,
+                      **options)
+        if data['type'] is not None:
+            message.type = MsgType(data['type'])
+        if data['display_type'] is not None:
+            message.display_type = DisplayType(data['display_type'])
+        message.custom = data['custom']
+        message.content = data['content']
+        if data['notification'] is not None:
+            message.notification = UMNotification.from_dict(data['notification'])
+        message.set_policy(**data['policy'])
+        message.url = data['url']
+        message.upload_url = data['upload_url']
+        message.__set_device_lists(data['devices']['android'], data['devices']['ios'])
+        message.filter = data['filter']
+        message.alias_type = data['alias_type']
+        message.aliases = data['aliases']
+        message.alias_file = data['alias_file']
+        if data.get('device_type') is not None:
+            message.device_type = DeviceType(data['device_type'])
+        return message
+
+    def to_bytes(self):
+        """
+        compact encoding of to_dict, a version byte followed by the values without their names
+        equal messages encode to equal bytes, they can be kept in a queue or cache as is
+        and are decoded without building params
+        """
+        android_device_token, ios_device_token = self.__device_lists()
+        row = [self.out_biz_no, self.description, self.production_mode, self.thirdparty_id, self.app_key,
+               self.type.value if self.type is not None else None,
+               self.display_type.value if self.display_type is not None else None,
+               self.custom, self.content,
+               self.notification._to_row() if self.notification is not None else None,
+               getattr(self, 'start_time', None),
+               getattr(self, 'expire_time', None),
+               getattr(self, 'max_send_num', None),
+               self.url, self.upload_url,
+               # tokens never contain commas, they are joined the same way in device_tokens
+               ','.join(android_device_token), ','.join(ios_device_token),
+               self.filter, self.alias_type, self.__alias_list(), self.alias_file,
+               self.device_type.value if self.device_type is not None else None]
+        return bytes((SERIAL_VERSION, )) + codec.dumps(row)
+
+    @classmethod
+    def from_bytes(cls, data, app_master_secret=None, **options):
+        """
+        same parameters as from_dict
+        """
+        _check_version(data[0])
+        (out_biz_no, description, production_mode, thirdparty_id, app_key, msg_type, display_type, custom, content,
+         notification, start_time, expire_time, max_send_num, url, upload_url,
+         android_device_token, ios_device_token, _filter, alias_type, aliases, alias_file,
+         device_type) = codec.loads(data[1:])
+        message = cls(out_biz_no, description,
+                      production_mode=production_mode,
+                      thirdparty_id=thirdparty_id,
+                      app_key=app_key,
+                      app_master_secret=app_master_secret,
+                      **options)
+        if msg_type is not None:
+            message.type = MsgType(msg_type)
+        if display_type is not None:
+            message.display_type = DisplayType(display_type)
+        message.custom = custom
+        message.content = content
+        if notification is not None:
+            message.notification = UMNotification._from_row(notification)
+        message.set_policy(start_time, expire_time, max_send_num)
+        message.url = url
+        message.upload_url = upload_url
+        message.__set_device_lists(android_device_token.split(',') if android_device_token else [],
+                                   ios_device_token.split(',') if ios_device_token else [])
+        message.filter = _filter
+        message.alias_type = alias_type
+        message.aliases = aliases
+        message.alias_file = alias_file
+        if device_type is not None:
+            message.device_type = DeviceType(device_type)
+        return message
+
     def set_unicast(self, device_token, device_type):
         self.type = MsgType.unicast
-        self.devices = [(device_token, device_type)]
+        self.devices = DeviceSet()
+        self.devices.add(device_token, device_type)
         return self
 
-    def set_listcast(self, devices):
+    def set_listcast(self, devices, stream=False):
+        """
+        :param devices,  # (token, type) 可迭代对象或 DeviceSet
+        :param stream=False,  # True 时不预先读取 devices，push_chunked 边读取边按平台分块发送
+        """
         self.type = MsgType.list_cast
+        if stream or isinstance(devices, DeviceSet):
+            self.devices = devices
+        else:
+            self.devices = DeviceSet(devices)
+        return self
+
+    def set_listcast_columns(self, tokens, types, stream=False):
+        """
+        listcast from parallel columns instead of (token, type) tuples
+        :param tokens,  # token 序列或可迭代对象
+        :param types,  # 与 tokens 对应的 DeviceType 或其 value，可以是 array.array/NumPy 数组
+        :param stream=False,  # 同 set_listcast
+        """
+        self.type = MsgType.list_cast
+        if stream:
+            self.devices = DeviceColumns(tokens, types)
+        else:
+            self.devices = DeviceSet().extend_columns(tokens, types)
+        return self
+
+    def set_filecast(self, devices):
+        """
+        :param devices,  # 任意 (token, type) 可迭代对象，如数据库游标或生成器，push 时才读取且只读取一次
+        """
+        self.type = MsgType.file_cast
         self.devices = devices
         return self
 
-    def set_broadcast(self):
+    def set_broadcast(self, device_type=None):
+        """
+        :param device_type=None,  # DeviceType，只发送到该平台，None 时每个平台各发送一次
+        """
         self.type = MsgType.broadcast
+        self.device_type = DeviceType(device_type) if device_type is not None else None
+        return self
+
+    def set_groupcast(self, expression, device_type=None):
+        """
+        devices selected by the server with a filter
+        :param expression,  # filters.Expression，如 tag('vip') & ~channel('test')，或已构造好的 filter dict
+        :param device_type=None,  # 同 set_broadcast
+        """
+        from .filters import Expression, where
+
+        self.type = MsgType.group_cast
+        self.filter = where(expression) if isinstance(expression, Expression) else expression
+        self.device_type = DeviceType(device_type) if device_type is not None else None
+        return self
+
+    def set_customizedcast(self, alias_type, aliases, use_file=False, device_type=None):
+        """
+        devices bound to the aliases of alias_type by the SDK
+        :param alias_type,  # 开发者在 SDK 中调用 addAlias 时使用的类型
+        :param aliases,  # alias 可迭代对象，每次请求最多50个，更多时使用 push_chunked 或 use_file
+        :param use_file=False,  # True 时 push 时才读取 aliases 并上传为文件，一次请求发送全部 alias
+        :param device_type=None,  # 同 set_broadcast
+        """
+        self.type = MsgType.customized_cast
+        self.alias_type = alias_type
+        self.aliases = aliases if use_file else list(aliases)
+        self.alias_file = use_file
+        self.device_type = DeviceType(device_type) if device_type is not None else None
         return self
 
     def set_message_custom(self, flag, message_body=None):
@@ -279,14 +773,14 @@ class UMMessage(object):
             m = hashlib.md5(s)
         return m.hexdigest()
 
-    def __build_android_params(self, device_tokens, params):
-        if not device_tokens:
+    def __build_android_params(self, target, params):
+        if target is None:
             return None
         if self.display_type is None:
             raise ValueError('display type is None, call set_notification/set_message first')
 
-        params.update({'device_tokens': ','.join(device_tokens),
-                       'payload': {'body': {},
+        params.update(target)
+        params.update({'payload': {'body': {},
                                    'display_type': self.display_type.value
                                    }})
 
@@ -343,11 +837,11 @@ class UMMessage(object):
 
         return params
 
-    def __build_ios_params(self, device_tokens, params):
-        if not device_tokens:
+    def __build_ios_params(self, target, params):
+        if target is None:
             return None
-        params.update({'device_tokens': ','.join(device_tokens),
-                       'payload': {'aps': {},
+        params.update(target)
+        params.update({'payload': {'aps': {},
                                    }})
         if getattr(self, 'notification') is None:
             params['payload']['aps'].update({'alert': "消息"})
@@ -365,16 +859,142 @@ class UMMessage(object):
         """
         pick up device tokens by device type
         """
-        android_device_token, ios_device_token = [], []
-        for token, _type in self.devices:
-            if _type == DeviceType.android or _type == DeviceType.android.value:
-                android_device_token.append(token)
-            elif _type == DeviceType.ios or _type == DeviceType.ios.value:
-                ios_device_token.append(token)
+        if isinstance(self.devices, DeviceSet):
+            android_device_token, ios_device_token = self.devices.android, self.devices.ios
+        else:
+            android_device_token, ios_device_token = [], []
+            for token, _type in self.devices:
+                if _type == DeviceType.android or _type == DeviceType.android.value:
+                    android_device_token.append(token)
+                elif _type == DeviceType.ios or _type == DeviceType.ios.value:
+                    ios_device_token.append(token)
+
+        if self.token_registry is not None:
+            android_device_token = self.token_registry.filter(android_device_token)
+            ios_device_token = self.token_registry.filter(ios_device_token)
 
         return android_device_token, ios_device_token
 
-    def __build_params(self):
+    def __build_targets(self):
+        """
+        build the fields addressing the devices of each platform, None when a platform has nothing to send
+        filecast messages upload their token files here
+        """
+        if self.type == MsgType.file_cast:
+            android_file_id, ios_file_id = self.__upload_files()
+            return ({'file_id': android_file_id} if android_file_id else None,
+                    {'file_id': ios_file_id} if ios_file_id else None)
+        if self.type == MsgType.broadcast:
+            return self.__platform_targets({})
+        if self.type == MsgType.group_cast:
+            return self.__platform_targets({'filter': self.filter})
+        if self.type == MsgType.customized_cast:
+            target = self.__aliases_target()
+            return self.__platform_targets(target) if target is not None else (None, None)
+
+        android_device_token, ios_device_token = self.__pick_tokens()
+        return self.__tokens_target(android_device_token), self.__tokens_target(ios_device_token)
+
+    def __platform_targets(self, target):
+        """
+        the same target for the platform of self.device_type, or for both platforms
+        every platform is a separate request with its own task_id and rate limit token
+        """
+        if self.device_type == DeviceType.android:
+            return target, None
+        if self.device_type == DeviceType.ios:
+            return None, target
+        return target, dict(target)
+
+    def __upload_files(self):
+        """
+        stream self.devices into one token file per platform and upload them
+        return (android_file_id, ios_file_id), None for a platform without tokens
+        """
+        android_body = _UploadBody(self.upload_url, self.app_key, self.app_master_secret)
+        ios_body = _UploadBody(self.upload_url, self.app_key, self.app_master_secret)
+        dead_tokens = self.token_registry if self.token_registry is not None else ()
+        try:
+            for token, _type in self.devices:
+                if token in dead_tokens:
+                    continue
+                if _type == DeviceType.android or _type == DeviceType.android.value:
+                    android_body.add(token)
+                elif _type == DeviceType.ios or _type == DeviceType.ios.value:
+                    ios_body.add(token)
+
+            return self.__upload_file_safe(android_body, 'android'), self.__upload_file_safe(ios_body, 'ios')
+        finally:
+            android_body.close()
+            ios_body.close()
+
+    def __aliases_target(self):
+        # aliases are not bound to a platform, __platform_targets decides where they are sent
+        if self.alias_file:
+            body = _UploadBody(self.upload_url, self.app_key, self.app_master_secret)
+            try:
+                for alias in self.aliases:
+                    body.add(alias)
+                if not body.count:
+                    raise ValueError('customizedcast has no aliases')
+                file_id = self.__upload_file_safe(body, None)
+            finally:
+                body.close()
+            if file_id is None:
+                return None
+            return {'alias_type': self.alias_type, 'file_id': file_id}
+
+        if not self.aliases:
+            raise ValueError('customizedcast has no aliases')
+        if len(self.aliases) > MAX_ALIASES:
+            from .error_codes import UMPushError, APIServerErrorCode
+
+            # the server would reject the request, use push_chunked or use_file instead
+            raise UMPushError(APIServerErrorCode.ALIAS_GREATER_THAN_FIFTY, None)
+        return {'alias_type': self.alias_type, 'alias': ','.join(map(str, self.aliases))}
+
+    def __upload_file_safe(self, body, platform=None):
+        """
+        upload body with the retry_policy, return its file_id
+        failures are logged like send errors and return None, the platform is not sent
+        """
+        if not body.count:
+            return None
+        sign = body.finish()
+        try:
+            if self.retry_policy is None:
+                return self.__upload_file(body, sign)
+            # the timestamp is part of the signed file, retries send the same body and sign
+            return self.retry_policy.run(lambda: self.__upload_file(body, sign))
+        except Exception as e:
+            log.failed(self, platform, e)
+
+    def __upload_file(self, body, sign):
+        transport = self.transport or _get_transport()
+        r = transport.post(self.upload_url + '?sign='+sign, data=body)
+        log.debug_text('upload response', r.text)
+        if r.status_code == 200:
+            data = codec.loads(r.text)
+            if data.get('ret') == 'SUCCESS' and data.get('data', {}).get('file_id'):
+                return data['data']['file_id']
+
+        # raises UMPushError/UMHTTPError for the failure status codes
+        self._process_response(r.status_code, r.text, None)
+
+        from .error_codes import UMPushError, APIServerErrorCode
+
+        raise UMPushError(APIServerErrorCode.FILE_UPLOAD_FAILED, r.text)
+
+    def __tokens_target(self, device_tokens):
+        if not device_tokens:
+            return None
+        return {'device_tokens': ','.join(map(str, device_tokens))}
+
+    def _build_params(self, android_target=None, ios_target=None):
+        """
+        return (android_params, ios_params), None for a platform with nothing to send
+        targets default to the devices, filter or aliases of the message
+        """
         if self.type is None:
             raise ValueError('message type is None, call set_unicast/set_listcast/set_broadcast/set_message first')
 
@@ -401,79 +1021,323 @@ class UMMessage(object):
         if self.thirdparty_id is not None:
             params.update({'thirdparty_id': self.thirdparty_id})
 
-        android_device_token, ios_device_token = self.__pick_tokens()
+        if android_target is None and ios_target is None:
+            android_target, ios_target = self.__build_targets()
         import copy
-        self.android_params = self.__build_android_params(android_device_token, copy.deepcopy(params))
-        self.ios_params = self.__build_ios_params(ios_device_token, copy.deepcopy(params))
+        if self.metrics is None:
+            android_params, ios_params = copy.deepcopy(params), copy.deepcopy(params)
+        else:
+            started = time.perf_counter()
+            android_params, ios_params = copy.deepcopy(params), copy.deepcopy(params)
+            self.metrics.observe('deepcopy', None, time.perf_counter() - started)
+        self.android_params = self.__build_android_params(android_target, android_params)
+        self.ios_params = self.__build_ios_params(ios_target, ios_params)
 
         return self.android_params, self.ios_params
 
-    def __build_sign(self, params):
-        post_body = json.dumps(params)
-        logging.debug(post_body)
+    def __iter_chunks(self, chunk_size):
+        """
+        yield (DeviceType, tokens) with at most chunk_size tokens
+        streamed devices are partitioned as they are read, only the current chunk of each platform is kept
+        duplicates are not removed from streamed devices
+        customizedcast aliases are chunked the same way and every chunk is sent to the platforms of device_type
+        """
+        if self.type == MsgType.customized_cast:
+            if self.device_type is None:
+                device_types = (DeviceType.android, DeviceType.ios)
+            else:
+                device_types = (self.device_type, )
+            for start in range(0, len(self.aliases), chunk_size):
+                for device_type in device_types:
+                    yield device_type, self.aliases[start:start + chunk_size]
+            return
+
+        if isinstance(self.devices, (DeviceSet, list)):
+            android_device_token, ios_device_token = self.__pick_tokens()
+            for device_type, device_tokens in ((DeviceType.android, android_device_token),
+                                               (DeviceType.ios, ios_device_token)):
+                for start in range(0, len(device_tokens), chunk_size):
+                    yield device_type, device_tokens[start:start + chunk_size]
+            return
+
+        registry = self.token_registry
+        platforms = DeviceSet._PLATFORMS
+        device_types = (DeviceType.android, DeviceType.ios)
+        chunks = [[], []]
+        for token, _type in self.devices:
+            index = platforms.get(_type)
+            if index is None or (registry is not None and token in registry):
+                continue
+            chunk = chunks[index]
+            chunk.append(token)
+            if len(chunk) == chunk_size:
+                yield device_types[index], chunk
+                chunks[index] = []
+        for index, chunk in enumerate(chunks):
+            if chunk:
+                yield device_types[index], chunk
+
+    def _encode_body(self, params, timestamp):
+        """
+        encode params once, the returned bytes are both signed and sent
+        """
+        # a retried request must not be rejected with TIMESTAMP_EXPIRED
+        params['timestamp'] = timestamp
+        return codec.dumps(params)
 
-        sign = self.__md5('{}{}{}{}'.format('POST', self.url, post_body, self.app_master_secret))
+    def _build_sign(self, post_body):
+        sign = self.__md5(b''.join([b'POST', self.url.encode(), post_body, self.app_master_secret.encode()]))
         return sign
 
-    def __process_rt_data(self, ret_text):
+    def _process_rt_data(self, ret_text):
         # process return data
-        data = json.loads(ret_text)
-        logging.debug(data)
-        print(data)
+        data = codec.loads(ret_text)
         if data.get('ret') == 'SUCCESS':
             msg_data = MsgReturnData(ret=data.get('ret'),
                                      thirdparty_id=data.get('data').get('thirdparty_id'),
-                                     msg_id=data.get('data').get('msg_id'))
+                                     msg_id=data.get('data').get('msg_id'),
+                                     task_id=data.get('data').get('task_id'))
         else:
             msg_data = MsgReturnData(ret=data.get('ret'),
                                      thirdparty_id=data.get('data').get('thirdparty_id'),
                                      error_code=data.get('data').get('error_code'))
-
-        print(msg_data)
         return msg_data
 
-    def __push_message(self, params):
+    def __acquire_rate_limit(self):
+        limiter = self.rate_limiter
+        if limiter is None:
+            return
+        if limiter.blocking:
+            if limiter.acquire(self.app_key, self.type):
+                return
+            wait = None
+        else:
+            wait = limiter.try_acquire(self.app_key, self.type)
+            if wait <= 0:
+                return
+
+        from .error_codes import UMRateLimitError
+
+        raise UMRateLimitError(self.app_key, self.type, wait)
+
+    def _push_platform(self, params, platform=None):
+        """
+        send the params of one platform, errors are raised instead of logged
+        """
         if not params:
             return
-        sign = self.__build_sign(params)
-        r = requests.post(self.url + '?sign='+sign, data=json.dumps(params))
-        logging.critical(r.text)
-        from .error_codes import HTTPStatusCode
+        return self._push_recorded(lambda timestamp: self._encode_body(params, timestamp), params, platform,
+                                   params.get('device_tokens'))
 
-        status_code = HTTPStatusCode(r.status_code)
+    def _push_recorded(self, render, params=None, platform=None, device_tokens=None):
+        """
+        _push_body recording device_tokens in token_registry when the server reports them invalid
+        :param device_tokens,  # 本次请求的 device_tokens 参数，逗号分隔
+        """
+        if self.token_registry is None:
+            return self._push_body(render, params, platform)
+
+        from .error_codes import UMPushError
+
+        try:
+            return self._push_body(render, params, platform)
+        except UMPushError as e:
+            self.token_registry.record_error(device_tokens, e.error_code)
+            raise
+
+    def _push_body(self, render, params=None, platform=None):
+        """
+        send the body returned by render(timestamp) with rate limiting and retries
+        render is called for every attempt so each one is signed with a fresh timestamp
+        :param platform,  # 'android' 或 'ios'，用于 metrics
+        """
+        if self.retry_policy is None:
+            return self.__push_body_once(render, params, platform)
+        return self.retry_policy.run(lambda: self.__push_body_once(render, params, platform))
+
+    def __push_body_once(self, render, params, platform=None):
+        metrics = self._metrics()
+        self.__acquire_rate_limit()
+        post_body, sign = self._sign_body(render, platform, metrics)
+        transport = self.transport or _get_transport()
+        metrics.inflight(1)
+        started = time.perf_counter()
+        try:
+            r = transport.post(self.url + '?sign='+sign, data=post_body)
+        finally:
+            metrics.inflight(-1)
+            metrics.observe('http', platform, time.perf_counter() - started)
+        return self._read_response(r.status_code, r.text, params, platform, metrics)
+
+    def _metrics(self):
+        return self.metrics if self.metrics is not None else NULL_METRICS
+
+    def _sign_body(self, render, platform, metrics):
+        """
+        render and sign the body of one attempt, return (post_body, sign)
+        shared by every send path, the request itself is sent by the caller
+        """
+        started = time.perf_counter()
+        post_body = render(int(time.time() * 1000))
+        encoded = time.perf_counter()
+        metrics.observe('encode', platform, encoded - started)
+        log.debug_text('request', post_body)
+        sign = self._build_sign(post_body)
+        metrics.observe('sign', platform, time.perf_counter() - encoded)
+        return post_body, sign
+
+    def _read_response(self, http_code, ret_text, params, platform, metrics):
+        """
+        MsgReturnData of the response to one attempt, raises UMPushError/UMHTTPError for failures
+        """
+        started = time.perf_counter()
+        metrics.count_status(http_code)
+        log.debug_text('response', ret_text)
+
+        from .error_codes import UMPushError
+
+        try:
+            data = self._process_response(http_code, ret_text, params)
+        except UMPushError as e:
+            metrics.count_error(e.error_code)
+            raise
+        finally:
+            metrics.observe('parse', platform, time.perf_counter() - started)
+        log.sent(self, platform, data)
+        return data
+
+    def _process_response(self, http_code, ret_text, params):
+        from .error_codes import HTTPStatusCode, UMHTTPError
+
+        try:
+            status_code = HTTPStatusCode(http_code)
+        except ValueError:
+            raise UMHTTPError(http_code)
         if status_code == HTTPStatusCode.OK:
             # return success
-            rt_data = self.__process_rt_data(r.text)
+            rt_data = self._process_rt_data(ret_text)
             return rt_data
         elif status_code == HTTPStatusCode.INTERNAL_SERVER_ERROR:
             # return failure
-            rt_data = self.__process_rt_data(r.text)
+            rt_data = self._process_rt_data(ret_text)
 
             from .error_codes import UMPushError, APIServerErrorCode
 
             raise UMPushError(APIServerErrorCode(int(rt_data.error_code)), params)
         else:
-            from .error_codes import UMHTTPError
-
             raise UMHTTPError(status_code)
 
-    def push(self, ):
-
-        android_params, ios_params = self.__build_params()
-        a_data, i_data = None, None
-
+    def __push_message_safe(self, params, platform=None):
         try:
-            a_data = self.__push_message(android_params)
+            return self._push_platform(params, platform)
         except Exception as e:
-            logging.exception(e)
+            log.failed(self, platform, e)
 
-        try:
-            i_data = self.__push_message(ios_params)
-        except Exception as e:
-            logging.exception(e)
+    def push(self, concurrent=False):
+        """
+        :param concurrent=False,  # True 时 android/ios 两个请求同时发送
+        """
+        if self.dedup_cache is None:
+            android_params, ios_params = self._build_params_measured()
+            return self._push_params(android_params, ios_params, concurrent)
+
+        cached = self._cached_result()
+        if cached is not None:
+            return cached
+
+        android_params, ios_params = self._build_params_measured()
+        a_data, i_data = self._push_params(android_params, ios_params, concurrent)
+        self._remember_result(android_params, ios_params, a_data, i_data)
+        return a_data, i_data
+
+    def _cached_result(self):
+        """
+        (a_data, i_data) of the last successful push with this out_biz_no, None when unknown or without dedup_cache
+        """
+        if self.dedup_cache is None:
+            return None
+        return self.dedup_cache.get('{}:{}'.format(self.app_key, self.out_biz_no))
+
+    def _remember_result(self, android_params, ios_params, a_data, i_data):
+        # only fully sent messages are remembered, a failed platform may still be retried by the caller
+        if self.dedup_cache is None:
+            return
+        if all(data is not None and data.ret == 'SUCCESS'
+               for params, data in ((android_params, a_data), (ios_params, i_data)) if params):
+            self.dedup_cache.set('{}:{}'.format(self.app_key, self.out_biz_no), (a_data, i_data))
+
+    def _build_params_measured(self):
+        if self.metrics is None:
+            return self._build_params()
+        started = time.perf_counter()
+        params = self._build_params()
+        self.metrics.observe('build', None, time.perf_counter() - started)
+        return params
+
+    def _push_params(self, android_params, ios_params, concurrent=False):
+        """
+        send params built before, e.g. restored from outbox.Outbox
+        """
+        if concurrent and android_params and ios_params:
+            executor = _get_platform_executor()
+            i_future = executor.submit(self.__push_message_safe, ios_params, 'ios')
+            a_data = self.__push_message_safe(android_params, 'android')
+            return a_data, i_future.result()
+
+        a_data = self.__push_message_safe(android_params, 'android')
+        i_data = self.__push_message_safe(ios_params, 'ios')
 
         return a_data, i_data
 
+    def push_chunked(self, chunk_size=MAX_DEVICE_TOKENS, max_workers=CHUNK_EXECUTOR_WORKERS):
+        """
+        split the devices, or customizedcast aliases, into requests of at most chunk_size per platform
+        and send them in parallel, chunk N is sent with out_biz_no '<out_biz_no>-N'
+        other message types are sent with push()
+        :param chunk_size=50,  # 服务器限制每次最多50个device_tokens
+        :param max_workers,  # 同时发送的请求数
+        :return (android_results, ios_results), MsgReturnData list in chunk order, None for a failed chunk
+        """
+        if self.type == MsgType.customized_cast and not self.alias_file:
+            field = 'alias'
+            android_params, ios_params = self._build_params(
+                *self.__platform_targets({'alias_type': self.alias_type, 'alias': ''}))
+        elif self.type in (MsgType.unicast, MsgType.list_cast):
+            field = 'device_tokens'
+            android_params, ios_params = self._build_params({'device_tokens': ''}, {'device_tokens': ''})
+        else:
+            # a single request already reaches every device of the other types
+            a_data, i_data = self.push()
+            return [a_data], [i_data]
+        params = {DeviceType.android: android_params, DeviceType.ios: ios_params}
+        futures = {DeviceType.android: [], DeviceType.ios: []}
+        # bounds the chunks read ahead of the requests, streamed devices are never all in memory
+        pending = threading.BoundedSemaphore(max_workers * 2)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='umeng_push_chunk') as executor:
+            for device_type, device_tokens in self.__iter_chunks(chunk_size):
+                platform_futures = futures[device_type]
+                policy = dict(params[device_type]['policy'],
+                              out_biz_no='{}-{}'.format(self.out_biz_no, len(platform_futures)))
+                chunk_params = dict(params[device_type], policy=policy)
+                chunk_params[field] = ','.join(map(str, device_tokens))
+                pending.acquire()
+                future = executor.submit(self.__push_message_safe, chunk_params, device_type.name)
+                future.add_done_callback(lambda _: pending.release())
+                platform_futures.append(future)
+        return ([future.result() for future in futures[DeviceType.android]],
+                [future.result() for future in futures[DeviceType.ios]])
+
+    def compile(self):
+        """
+        pre-encode the payload of each platform once, see template.CompiledMessage
+        """
+        from .template import CompiledMessage
+
+        return CompiledMessage(self)
+
 
 if __name__ == "__main__":
     UMENG_APP_KEY = ''
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'DedupCache',
+    'SQLiteDedupCache',
+]
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+from .connect import MsgReturnData
+from .localdb import thread_connection
+
+
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TTL = 600  # 秒
+EVICT_EVERY = 100
+
+
+class DedupCache(object):
+    """
+    results of recently pushed out_biz_no in this process, evicted by ttl and least recently used
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return the cached (a_data, i_data), None on a miss
+        """
+        now = time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _dump_result(data):
+    return None if data is None else data.to_dict()
+
+
+def _load_result(data):
+    return None if data is None else MsgReturnData(**data)
+
+
+class SQLiteDedupCache(object):
+    """
+    DedupCache stored in a local sqlite file shared by every worker process of the host
+    """
+
+    def __init__(self, path, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS dedup '
+                                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS dedup_used ON dedup (used)')
+
+    @property
+    def connection(self):
+        return thread_connection(self.local, self.path)
+
+    def get(self, key):
+        now = time.time()
+        row = self.connection.execute('SELECT value FROM dedup WHERE key = ? AND expires >= ?', (key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.connection.execute('UPDATE dedup SET used = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        a_data, i_data = json.loads(row[0])
+        return _load_result(a_data), _load_result(i_data)
+
+    def set(self, key, value):
+        now = time.time()
+        a_data, i_data = value
+        connection = self.connection
+        connection.execute('INSERT OR REPLACE INTO dedup (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                           (key, json.dumps([_dump_result(a_data), _dump_result(i_data)]), now + self.ttl, now))
+        self.sets += 1
+        if self.sets % EVICT_EVERY == 0:
+            # eviction scans the table, amortize it over many sets
+            connection.execute('DELETE FROM dedup WHERE expires < ?', (now, ))
+            connection.execute('DELETE FROM dedup WHERE key IN '
+                               '(SELECT key FROM dedup ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.maxsize, ))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM dedup').fetchone()[0]
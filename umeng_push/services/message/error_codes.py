@@ -8,7 +8,8 @@ __all__ = [
     'HTTPStatusCode',
     'APIServerErrorCode',
     'UMPushError',
-    'UMHTTPError'
+    'UMHTTPError',
+    'UMRateLimitError',
 ]
 
 from enum import Enum
@@ -31,6 +32,17 @@ class UMHTTPError(Exception):
     def __init__(self, http_code):
         super(UMHTTPError, self).__init__("HTTP Code {}".format(http_code))
 
+        self.http_code = getattr(http_code, 'value', http_code)
+
+
+class UMRateLimitError(Exception):
+    def __init__(self, app_key, msg_type, wait=None):
+        super(UMRateLimitError, self).__init__("Rate limit exceeded {} {}".format(app_key, msg_type))
+
+        self.app_key = app_key
+        self.msg_type = msg_type
+        self.wait = wait  # 秒，下一个令牌可用前的等待时间，未知时为 None
+
 
 class HTTPStatusCode(Enum):
     OK = 200
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'Expression',
+    'Condition',
+    'All',
+    'Any',
+    'Not',
+    'where',
+    'tag',
+    'app_version',
+    'channel',
+    'device_model',
+    'province',
+    'country',
+    'language',
+    'launch_from',
+    'not_launch_from',
+]
+
+from abc import ABCMeta, abstractmethod
+
+
+class Expression(metaclass=ABCMeta):
+    """
+    node of a groupcast filter, combined with & | ~
+    (tag('vip') | tag('beta')) & ~channel('test') & app_version('>=2.0')
+    """
+    __slots__ = ()
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    @abstractmethod
+    def to_dict(self):
+        """
+        the filter dict of this node
+        """
+
+
+class Condition(Expression):
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def to_dict(self):
+        return {self.key: self.value}
+
+
+class _Group(Expression):
+    __slots__ = ('expressions', )
+    operator = None
+
+    def __init__(self, *expressions):
+        # (a & b) & c is sent as one "and" of three conditions
+        flat = []
+        for expression in expressions:
+            if type(expression) is type(self):
+                flat.extend(expression.expressions)
+            else:
+                flat.append(expression)
+        self.expressions = tuple(flat)
+
+    def to_dict(self):
+        return {self.operator: [expression.to_dict() for expression in self.expressions]}
+
+
+class All(_Group):
+    __slots__ = ()
+    operator = 'and'
+
+
+class Any(_Group):
+    __slots__ = ()
+    operator = 'or'
+
+
+class Not(Expression):
+    __slots__ = ('expression', )
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def to_dict(self):
+        return {'not': self.expression.to_dict()}
+
+
+def where(expression):
+    """
+    the filter parameter of a groupcast, the server requires an "and" at the top
+    """
+    if not isinstance(expression, All):
+        expression = All(expression)
+    return {'where': expression.to_dict()}
+
+
+def tag(value):
+    return Condition('tag', value)
+
+
+def app_version(value):
+    """
+    :param value,  # 如 "1.0"、">=1.0"、"<2.0"
+    """
+    return Condition('app_version', value)
+
+
+def channel(value):
+    return Condition('channel', value)
+
+
+def device_model(value):
+    return Condition('device_model', value)
+
+
+def province(value):
+    return Condition('province', value)
+
+
+def country(value):
+    return Condition('country', value)
+
+
+def language(value):
+    return Condition('language', value)
+
+
+def launch_from(value):
+    """
+    :param value,  # "YYYY-MM-DD"，该日期之后启动过应用的设备
+    """
+    return Condition('launch_from', value)
+
+
+def not_launch_from(value):
+    """
+    :param value,  # "YYYY-MM-DD"，该日期之后未启动过应用的设备
+    """
+    return Condition('not_launch_from', value)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'thread_connection',
+]
+
+import sqlite3
+
+
+def thread_connection(local, path):
+    """
+    the sqlite connection of the calling thread kept in `local`, a threading.local of the owner
+    sqlite connections must stay in the thread that opened them, every one is opened in autocommit WAL mode
+    so several threads and processes can share the file
+    """
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        local.connection = connection
+    return connection
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'logger',
+    'set_success_sample_rate',
+    'get_success_sample_rate',
+]
+
+import logging
+import random
+
+
+logger = logging.getLogger('umeng_push')
+
+# 成功发送的 INFO 日志采样比例，0 表示不记录，1 表示全部记录
+DEFAULT_SUCCESS_SAMPLE_RATE = 0.01
+
+_success_sample_rate = DEFAULT_SUCCESS_SAMPLE_RATE
+
+
+def set_success_sample_rate(rate):
+    global _success_sample_rate
+    if not 0 <= rate <= 1:
+        raise ValueError('sample rate must be between 0 and 1')
+    _success_sample_rate = rate
+
+
+def get_success_sample_rate():
+    return _success_sample_rate
+
+
+def _fields(message, platform):
+    return {'app_key': message.app_key,
+            'out_biz_no': message.out_biz_no,
+            'msg_type': message.type.value if message.type is not None else None,
+            'platform': platform}
+
+
+def debug_text(label, text):
+    """
+    log a request body or response text, nothing is formatted unless DEBUG is enabled for 'umeng_push'
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        logger.debug('umeng push %s: %s', label, text)
+
+
+def sent(message, platform, data):
+    """
+    log a MsgReturnData, successes are sampled at INFO, failures are always logged at WARNING
+    """
+    if data.ret != 'SUCCESS':
+        _api_error(message, platform, data.error_code)
+        return
+    rate = _success_sample_rate
+    if not rate or not logger.isEnabledFor(logging.INFO):
+        return
+    if rate < 1 and random.random() >= rate:
+        return
+    fields = _fields(message, platform)
+    fields.update(msg_id=data.msg_id, sample_rate=rate)
+    logger.info('umeng push sent %s', data.msg_id, extra=fields)
+
+
+def _api_error(message, platform, error_code):
+    if not logger.isEnabledFor(logging.WARNING):
+        return
+    from .error_codes import APIServerErrorCode
+
+    try:
+        error_name = APIServerErrorCode(int(error_code)).name
+    except (TypeError, ValueError):
+        error_name = 'UNKNOWN'
+    fields = _fields(message, platform)
+    fields.update(error_code=error_code, error_name=error_name)
+    logger.warning('umeng push failed: %s %s', error_code, error_name, extra=fields)
+
+
+def failed(message, platform, error):
+    """
+    log an exception raised by a send, API and HTTP errors as fields without the request params
+    """
+    from .error_codes import UMPushError, UMHTTPError, UMRateLimitError
+
+    if isinstance(error, UMPushError):
+        _api_error(message, platform, error.error_code)
+    elif isinstance(error, UMHTTPError):
+        fields = _fields(message, platform)
+        fields.update(http_status=error.http_code)
+        logger.warning('umeng push failed: HTTP %s', error.http_code, extra=fields)
+    elif isinstance(error, UMRateLimitError):
+        logger.warning('umeng push rate limited', extra=_fields(message, platform))
+    else:
+        logger.error('umeng push failed: %s', error, exc_info=error, extra=_fields(message, platform))
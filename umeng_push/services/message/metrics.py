@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'Metrics',
+    'Histogram',
+    'NullMetrics',
+    'NULL_METRICS',
+]
+
+import bisect
+import threading
+
+
+# 秒
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(**labels):
+    return ','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    metrics registry passed to UMMessage(metrics=...)
+    any object with the same four hook methods can be used instead, e.g. to forward to statsd
+    phases: build, deepcopy, encode, sign, http, parse
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='umeng_push', labels=None):
+        """
+        :param labels,  # 加到每条指标上的固定标签，如 {'app_key': ...}
+        """
+        self.buckets = buckets
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self.lock = threading.Lock()
+        self.phases = {}  # (phase, platform) -> Histogram
+        self.http_status = {}  # http code -> count
+        self.error_codes = {}  # APIServerErrorCode value -> count
+        self.in_flight = 0
+
+    def observe(self, phase, platform, seconds):
+        key = (phase, platform or 'all')
+        with self.lock:
+            histogram = self.phases.get(key)
+            if histogram is None:
+                histogram = self.phases[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count_status(self, http_code):
+        with self.lock:
+            self.http_status[http_code] = self.http_status.get(http_code, 0) + 1
+
+    def count_error(self, error_code):
+        with self.lock:
+            self.error_codes[error_code] = self.error_codes.get(error_code, 0) + 1
+
+    def inflight(self, delta):
+        with self.lock:
+            self.in_flight += delta
+
+    def render_prometheus(self):
+        """
+        return the metrics in the prometheus text exposition format
+        """
+        from .error_codes import APIServerErrorCode
+
+        def _labels(**labels):
+            return _format_labels(**dict(self.labels, **labels))
+
+        prefix = self.prefix
+        lines = []
+        with self.lock:
+            name = '{}_phase_seconds'.format(prefix)
+            lines.append('# HELP {} Time spent per push phase and platform.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (phase, platform), histogram in sorted(self.phases.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}}} {}'.format(
+                        name, _labels(phase=phase, platform=platform, le=bound), cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, _labels(phase=phase, platform=platform), histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(name, _labels(phase=phase, platform=platform),
+                                                        histogram.count))
+
+            name = '{}_http_responses_total'.format(prefix)
+            lines.append('# HELP {} HTTP responses per status code.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for code, count in sorted(self.http_status.items()):
+                lines.append('{}{{{}}} {}'.format(name, _labels(code=code), count))
+
+            name = '{}_api_errors_total'.format(prefix)
+            lines.append('# HELP {} API errors per APIServerErrorCode.'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for code, count in sorted(self.error_codes.items()):
+                try:
+                    error_name = APIServerErrorCode(code).name
+                except ValueError:
+                    error_name = 'UNKNOWN'
+                lines.append('{}{{{}}} {}'.format(name, _labels(code=code, name=error_name), count))
+
+            name = '{}_in_flight_requests'.format(prefix)
+            lines.append('# HELP {} Requests waiting for a response.'.format(name))
+            lines.append('# TYPE {} gauge'.format(name))
+            if self.labels:
+                lines.append('{}{{{}}} {}'.format(name, _labels(), self.in_flight))
+            else:
+                lines.append('{} {}'.format(name, self.in_flight))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(object):
+    """
+    the four Metrics hooks doing nothing, used by UMMessage when metrics is None
+    """
+    __slots__ = ()
+
+    def observe(self, phase, platform, seconds):
+        pass
+
+    def count_status(self, http_code):
+        pass
+
+    def count_error(self, error_code):
+        pass
+
+    def inflight(self, delta):
+        pass
+
+
+NULL_METRICS = NullMetrics()
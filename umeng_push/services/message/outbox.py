@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'Outbox',
+    'Dispatcher',
+    'OutboxStatus',
+]
+
+import json
+import threading
+import time
+
+from enum import Enum
+
+from . import log
+from .connect import UMMessage, MsgType
+from .localdb import thread_connection
+
+
+DEFAULT_LEASE = 60  # 秒，取出后超过该时间未完成的消息会被重新发送
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_DISPATCHER_WORKERS = 8
+DEFAULT_BATCH_SIZE = 16
+
+
+class OutboxStatus(Enum):
+    pending = 0
+    sending = 1
+    sent = 2
+    failed = 3
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    app_key TEXT NOT NULL,
+    out_biz_no TEXT NOT NULL,
+    type TEXT NOT NULL,
+    android_params TEXT,
+    ios_params TEXT,
+    android_result TEXT,
+    ios_result TEXT,
+    status INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    claimed REAL,
+    PRIMARY KEY (app_key, out_biz_no)
+);
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, claimed);
+'''
+
+
+def _dump_result(data):
+    if data is None:
+        return None
+    return json.dumps(data.to_dict())
+
+
+class Outbox(object):
+    """
+    messages persisted in a local sqlite file until a Dispatcher has sent them
+    (app_key, out_biz_no) is the key like in dedup.DedupCache, enqueueing the same pair again is ignored
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        self.connection.executescript(_SCHEMA)
+
+    @property
+    def connection(self):
+        return thread_connection(self.local, self.path)
+
+    def enqueue(self, message):
+        """
+        build the params of message and store them
+        :return False when out_biz_no was already enqueued for this app
+        """
+        if message.type == MsgType.file_cast or (message.type == MsgType.customized_cast and message.alias_file):
+            raise ValueError('filecast and alias file messages upload files while building, push them directly')
+        android_params, ios_params = message._build_params()
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO outbox (out_biz_no, app_key, type, android_params, ios_params, status, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (message.out_biz_no, message.app_key, message.type.value,
+             json.dumps(android_params) if android_params else None,
+             json.dumps(ios_params) if ios_params else None,
+             OutboxStatus.pending.value, time.time()))
+        return cursor.rowcount == 1
+
+    def claim(self, limit):
+        """
+        take up to limit pending messages, and messages whose lease expired, for sending
+        a message whose lease expired after max_attempts claims, e.g. one that keeps crashing its dispatcher,
+        is marked failed instead
+        """
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'UPDATE outbox SET status = ?, claimed = NULL WHERE status = ? AND claimed < ? AND attempts >= ?',
+                (OutboxStatus.failed.value, OutboxStatus.sending.value, now - self.lease, self.max_attempts))
+            rows = connection.execute(
+                'SELECT out_biz_no, app_key, type, android_params, ios_params, android_result, ios_result '
+                'FROM outbox WHERE status = ? OR (status = ? AND claimed < ? AND attempts < ?) LIMIT ?',
+                (OutboxStatus.pending.value, OutboxStatus.sending.value, now - self.lease, self.max_attempts,
+                 limit)).fetchall()
+            connection.executemany(
+                'UPDATE outbox SET status = ?, claimed = ?, attempts = attempts + 1 '
+                'WHERE app_key = ? AND out_biz_no = ?',
+                [(OutboxStatus.sending.value, now, row[1], row[0]) for row in rows])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return rows
+
+    def complete(self, app_key, out_biz_no, a_data, i_data, sent):
+        """
+        record the MsgReturnData of each platform, failed messages go back to pending until max_attempts
+        """
+        if sent:
+            status = OutboxStatus.sent.value
+        else:
+            status = OutboxStatus.pending.value
+        self.connection.execute(
+            'UPDATE outbox SET android_result = COALESCE(?, android_result), ios_result = COALESCE(?, ios_result), '
+            'status = CASE WHEN ? = ? AND attempts >= ? THEN ? ELSE ? END, claimed = NULL '
+            'WHERE app_key = ? AND out_biz_no = ?',
+            (_dump_result(a_data), _dump_result(i_data),
+             status, OutboxStatus.pending.value, self.max_attempts, OutboxStatus.failed.value, status,
+             app_key, out_biz_no))
+
+    def status(self, app_key, out_biz_no):
+        """
+        :return (OutboxStatus, android_result dict, ios_result dict), None when unknown
+        """
+        row = self.connection.execute(
+            'SELECT status, android_result, ios_result FROM outbox WHERE app_key = ? AND out_biz_no = ?',
+            (app_key, out_biz_no)).fetchone()
+        if row is None:
+            return None
+        return (OutboxStatus(row[0]),
+                json.loads(row[1]) if row[1] else None,
+                json.loads(row[2]) if row[2] else None)
+
+    def pending_count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM outbox WHERE status IN (?, ?)',
+                                       (OutboxStatus.pending.value, OutboxStatus.sending.value)).fetchone()[0]
+
+
+def _succeeded(result):
+    return result is not None and json.loads(result).get('ret') == 'SUCCESS'
+
+
+class Dispatcher(object):
+    """
+    worker threads draining an Outbox, several processes may run a Dispatcher on the same file
+    """
+
+    def __init__(self,
+                 outbox,
+                 secrets,  # {app_key: app_master_secret} 或 callable(app_key)，密钥不写入 outbox
+                 workers=DEFAULT_DISPATCHER_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 poll_interval=0.5,  # 秒，outbox 为空时的等待时间
+                 **message_options  # 传给 UMMessage 的其它参数，如 transport/rate_limiter/retry_policy
+                 ):
+        self.outbox = outbox
+        self.secrets = secrets
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.message_options = message_options
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def __secret(self, app_key):
+        if callable(self.secrets):
+            return self.secrets(app_key)
+        return self.secrets[app_key]
+
+    def dispatch(self, row):
+        out_biz_no, app_key, msg_type, android_params, ios_params, android_result, ios_result = row
+        message = UMMessage(out_biz_no=out_biz_no,
+                            description=None,
+                            app_key=app_key,
+                            app_master_secret=self.__secret(app_key),
+                            **self.message_options)
+        message.type = MsgType(msg_type)
+
+        # a platform sent before a restart or a partial failure is not sent twice
+        android_params = None if _succeeded(android_result) else android_params
+        ios_params = None if _succeeded(ios_result) else ios_params
+        a_data, i_data = message._push_params(json.loads(android_params) if android_params else None,
+                                              json.loads(ios_params) if ios_params else None)
+
+        sent = ((android_params is None or (a_data is not None and a_data.ret == 'SUCCESS')) and
+                (ios_params is None or (i_data is not None and i_data.ret == 'SUCCESS')))
+        self.outbox.complete(app_key, out_biz_no, a_data, i_data, sent)
+        return sent
+
+    def run_once(self):
+        """
+        send one batch in the calling thread, return the number of messages claimed
+        """
+        rows = self.outbox.claim(self.batch_size)
+        for row in rows:
+            try:
+                self.dispatch(row)
+            except Exception as e:
+                log.logger.error('umeng push outbox dispatch failed: %s', e, exc_info=e,
+                                 extra={'app_key': row[1], 'out_biz_no': row[0]})
+                self.outbox.complete(row[1], row[0], None, None, False)
+        return len(rows)
+
+    def __run(self):
+        while not self.stopping.is_set():
+            try:
+                if not self.run_once():
+                    self.stopping.wait(self.poll_interval)
+            except Exception:
+                log.logger.exception('umeng push outbox dispatcher failed')
+                self.stopping.wait(self.poll_interval)
+
+    def start(self):
+        self.stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__run, name='umeng_push_dispatcher_{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
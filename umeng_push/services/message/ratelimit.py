@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'RateLimiter',
+    'MemoryBackend',
+    'FileBackend',
+]
+
+import json
+import os
+import threading
+import time
+
+
+# (次数, 秒)，None 表示不限速。广播、文件播、组播每分钟最多10次
+DEFAULT_RATES = {
+    'unicast': None,
+    'listcast': None,
+    'customizedcast': None,
+    'broadcast': (10, 60),
+    'filecast': (10, 60),
+    'groupcast': (10, 60),
+}
+
+
+def _take(state, count, per, now):
+    """
+    refill the bucket state [tokens, updated] and take one token
+    return the new state and the seconds to wait, 0 when the token was taken
+    """
+    if state is None:
+        tokens, updated = float(count), now
+    else:
+        tokens, updated = state
+        tokens = min(float(count), tokens + (now - updated) * count / per)
+
+    if tokens >= 1:
+        return [tokens - 1, now], 0.0
+    return [tokens, now], (1 - tokens) * per / count
+
+
+class MemoryBackend(object):
+    """
+    token buckets of the current process
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, count, per):
+        with self.lock:
+            state, wait = _take(self.buckets.get(key), count, per, time.time())
+            self.buckets[key] = state
+        return wait
+
+
+class FileBackend(object):
+    """
+    token buckets stored in a local json file, shared by every process that uses the same path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def take(self, key, count, per):
+        import fcntl
+
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        buckets = json.load(f)
+                    except ValueError:
+                        buckets = {}
+                    state, wait = _take(buckets.get(key), count, per, time.time())
+                    buckets[key] = state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(buckets, f)
+            finally:
+                os.close(fd)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    client side token bucket per app_key and message type, consulted by UMMessage before each send
+    """
+
+    def __init__(self,
+                 rates=None,  # {'broadcast': (10, 60), ...}，覆盖 DEFAULT_RATES
+                 backend=None,  # 默认 MemoryBackend，多进程共享用 FileBackend
+                 blocking=True,  # UMMessage 发送时是否等待令牌
+                 timeout=None,  # 等待令牌的最长秒数，None 表示一直等待
+                 ):
+        self.rates = dict(DEFAULT_RATES)
+        for msg_type, rate in (rates or {}).items():
+            self.rates[getattr(msg_type, 'value', msg_type)] = rate
+        self.backend = backend or MemoryBackend()
+        self.blocking = blocking
+        self.timeout = timeout
+
+    def try_acquire(self, app_key, msg_type):
+        """
+        take a token without waiting
+        return 0 when it was taken, otherwise the seconds until one is available
+        """
+        msg_type = getattr(msg_type, 'value', msg_type)
+        rate = self.rates.get(msg_type)
+        if rate is None:
+            return 0.0
+        count, per = rate
+        return self.backend.take('{}:{}'.format(app_key, msg_type), count, per)
+
+    def acquire(self, app_key, msg_type, blocking=None, timeout=None):
+        """
+        :return True when a token was taken, False when not blocking or timed out
+        """
+        blocking = self.blocking if blocking is None else blocking
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            wait = self.try_acquire(app_key, msg_type)
+            if wait <= 0:
+                return True
+            if not blocking:
+                return False
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
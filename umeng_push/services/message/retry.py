@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'RetryPolicy',
+    'RETRYABLE_ERROR_CODES',
+]
+
+import asyncio
+import random
+import time
+
+from .error_codes import APIServerErrorCode, UMPushError, UMHTTPError
+from .log import logger
+
+
+# 服务器临时性错误，重试可能成功；其它错误码重试也不会成功
+RETRYABLE_ERROR_CODES = frozenset([
+    APIServerErrorCode.SERVICE_UPGRADE,
+    APIServerErrorCode.TIMESTAMP_EXPIRED,
+    APIServerErrorCode.DATABASE_ERROR_ONE,
+    APIServerErrorCode.DATABASE_ERROR_TWO,
+    APIServerErrorCode.DATABASE_ERROR_THREE,
+    APIServerErrorCode.DATABASE_ERROR_FOUR,
+    APIServerErrorCode.DATABASE_ERROR_FIVE,
+    APIServerErrorCode.SYSTEM_ERROR,
+    APIServerErrorCode.SYSTEM_BUSY,
+    APIServerErrorCode.FULL_QUEUE,
+    APIServerErrorCode.ASYNCHRONOUS_SEND_MESSAGE_FAILED,
+    APIServerErrorCode.HSF_TIME_OUT,
+    APIServerErrorCode.SERVER_NET_ERROR,
+])
+
+
+class RetryPolicy(object):
+    """
+    retry transient failures with jittered exponential backoff
+    every attempt is a new request with a fresh timestamp and sign, out_biz_no keeps the retries idempotent
+    """
+
+    def __init__(self,
+                 max_attempts=3,
+                 base_delay=0.2,  # 秒，第 n 次重试前最多等待 base_delay * 2 ** n
+                 max_delay=5.0,
+                 deadline=30.0,  # 秒，从第一次发送起超过该时间不再重试，None 表示不限
+                 retryable_codes=RETRYABLE_ERROR_CODES,
+                 ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_codes = frozenset(retryable_codes)
+
+    def is_retryable(self, error):
+        if isinstance(error, UMPushError):
+            try:
+                return APIServerErrorCode(error.error_code) in self.retryable_codes
+            except ValueError:
+                return False
+        if isinstance(error, UMHTTPError):
+            return error.http_code >= 500 or error.http_code == 429
+        # connection errors and timeouts, requests.RequestException is an IOError
+        return isinstance(error, (OSError, asyncio.TimeoutError))
+
+    def backoff(self, attempt):
+        """
+        full jitter delay before retry number `attempt` (starting at 1)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def __next_delay(self, attempt, error, started):
+        """
+        return the seconds to sleep before the next attempt, None when error must be raised
+        """
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        delay = self.backoff(attempt)
+        if self.deadline is not None and time.time() + delay - started > self.deadline:
+            return None
+        # the str() of UMPushError contains the request params, only the codes are logged
+        reason = getattr(error, 'error_code', None) or getattr(error, 'http_code', None) or type(error).__name__
+        logger.warning('umeng push attempt %s failed, retry in %.2fs: %s', attempt, delay, reason,
+                       extra={'attempt': attempt, 'retry_delay': delay, 'reason': reason})
+        return delay
+
+    def run(self, func):
+        """
+        call func() until it returns or raises a fatal error
+        """
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except Exception as e:
+                delay = self.__next_delay(attempt, e, started)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def run_async(self, func):
+        """
+        await func() until it returns or raises a fatal error
+        """
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func()
+            except Exception as e:
+                delay = self.__next_delay(attempt, e, started)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'TaskStatus',
+    'TaskInfo',
+    'UMTaskClient',
+    'TaskTracker',
+]
+
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+
+from . import codec
+from . import log
+from .config import resolve_credentials
+from .connect import _get_transport
+
+
+DEFAULT_API_URL = 'http://msg.umeng.com/api'
+DEFAULT_TRACKER_WORKERS = 8
+
+
+class TaskStatus(Enum):
+    queued = 0  # 排队中
+    sending = 1  # 发送中
+    done = 2  # 发送完成
+    failed = 3  # 发送失败
+    cancelled = 4  # 消息被撤销
+
+
+FINISHED_STATUSES = frozenset([TaskStatus.done, TaskStatus.failed, TaskStatus.cancelled])
+
+
+class TaskInfo(object):
+    __slots__ = ('task_id', 'status', 'total_count', 'accept_count', 'sent_count', 'open_count', 'dismiss_count')
+
+    def __init__(self,
+                 task_id,
+                 status,  # TaskStatus
+                 total_count=0,  # 消息总数
+                 accept_count=0,  # 消息受理数
+                 sent_count=0,  # 消息实际发送数
+                 open_count=0,  # 打开数
+                 dismiss_count=0,  # 忽略数
+                 ):
+        self.task_id = task_id
+        self.status = status
+        self.total_count = total_count
+        self.accept_count = accept_count
+        self.sent_count = sent_count
+        self.open_count = open_count
+        self.dismiss_count = dismiss_count
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        :param data,  # api/status 返回的 data
+        """
+        return cls(data.get('task_id'), TaskStatus(int(data['status'])),
+                   **{key: int(data.get(key) or 0) for key in cls.__slots__[2:]})
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def __str__(self):
+        return "{} {} {}/{}".format(self.task_id, self.status.name, self.sent_count, self.total_count)
+
+    def to_dict(self):
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data['status'] = self.status.value
+        return data
+
+
+class UMTaskClient(object):
+    """
+    status and cancel of the task_id returned for broadcast/groupcast/filecast/customizedcast messages
+    requests go through the same pooled transport as UMMessage
+    """
+
+    def __init__(self,
+                 app_key=None,  # 默认由 config.get_credentials() 获取
+                 app_master_secret=None,
+                 transport=None,  # 默认使用进程内共享的连接池 transport.get_transport()
+                 retry_policy=None,  # retry.RetryPolicy，None 表示不重试
+                 api_url=DEFAULT_API_URL,
+                 ):
+        app_key, app_master_secret = resolve_credentials(app_key, app_master_secret)
+
+        self.app_key = app_key
+        self.app_master_secret = app_master_secret
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.status_url = api_url + '/status'
+        self.cancel_url = api_url + '/cancel'
+
+    def __post_once(self, url, task_id):
+        body = codec.dumps({'appkey': self.app_key, 'timestamp': int(time.time() * 1000), 'task_id': task_id})
+        sign = hashlib.md5(b''.join([b'POST', url.encode(), body, self.app_master_secret.encode()])).hexdigest()
+        transport = self.transport or _get_transport()
+        r = transport.post(url + '?sign=' + sign, data=body)
+        log.debug_text('task response', r.text)
+
+        from .error_codes import UMPushError, UMHTTPError, APIServerErrorCode
+
+        if r.status_code not in (200, 500):
+            raise UMHTTPError(r.status_code)
+        data = codec.loads(r.text)
+        if data.get('ret') == 'SUCCESS':
+            return data.get('data') or {}
+        raise UMPushError(APIServerErrorCode(int(data.get('data', {}).get('error_code'))), task_id)
+
+    def __post(self, url, task_id):
+        if self.retry_policy is None:
+            return self.__post_once(url, task_id)
+        return self.retry_policy.run(lambda: self.__post_once(url, task_id))
+
+    def status(self, task_id):
+        """
+        :return TaskInfo
+        """
+        return TaskInfo.from_data(dict(self.__post(self.status_url, task_id), task_id=task_id))
+
+    def cancel(self, task_id):
+        """
+        cancel a task that is not finished, raises UMPushError MESSAGE_CANCEL_FAILED otherwise
+        """
+        return self.__post(self.cancel_url, task_id).get('task_id', task_id)
+
+
+class _Tracked(object):
+    __slots__ = ('task_id', 'future', 'callbacks', 'interval', 'progress', 'errors')
+
+    def __init__(self, task_id, interval):
+        self.task_id = task_id
+        self.future = Future()
+        self.callbacks = []
+        self.interval = interval
+        self.progress = None
+        self.errors = 0
+
+
+class TaskTracker(object):
+    """
+    polls the status of many tasks from a small thread pool until they finish
+    every task is polled at min_interval while it makes progress, the interval grows by backoff up to
+    max_interval while its status and counts stay the same, tasks due at the same time are polled together
+    """
+
+    def __init__(self,
+                 client,  # UMTaskClient
+                 callback=None,  # callback(TaskInfo)，任一任务结束时调用
+                 workers=DEFAULT_TRACKER_WORKERS,  # 同时进行的查询请求数
+                 min_interval=1.0,  # 秒
+                 max_interval=60.0,  # 秒
+                 backoff=2.0,
+                 max_errors=5,  # 连续查询失败次数达到该值时放弃该任务
+                 ):
+        self.client = client
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='umeng_push_tasks')
+        self.condition = threading.Condition()
+        self.heap = []  # (poll time, sequence, _Tracked)
+        self.sequence = itertools.count()
+        self.tracked = {}  # task_id -> _Tracked
+        self.polls = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run, name='umeng_push_task_tracker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __schedule(self, tracked, delay):
+        # jitter keeps tasks tracked together from being polled in lock step forever
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay * random.uniform(0.9, 1.1), next(self.sequence), tracked))
+            self.condition.notify()
+
+    def track(self, task_id, callback=None):
+        """
+        poll task_id until it finishes
+        :param callback,  # callback(TaskInfo)，该任务结束时调用
+        :return concurrent.futures.Future of the final TaskInfo
+        """
+        if self.closed:
+            raise RuntimeError('tracker is stopped')
+        with self.condition:
+            tracked = self.tracked.get(task_id)
+            created = tracked is None
+            if created:
+                tracked = self.tracked[task_id] = _Tracked(task_id, self.min_interval)
+            if callback is not None:
+                tracked.callbacks.append(callback)
+        if created:
+            self.__schedule(tracked, 0)
+        return tracked.future
+
+    def cancel(self, task_id):
+        """
+        cancel task_id and track it until the server reports it cancelled
+        """
+        self.client.cancel(task_id)
+        return self.track(task_id)
+
+    def __run(self):
+        condition = self.condition
+        while True:
+            with condition:
+                while not self.heap and not self.closed:
+                    condition.wait()
+                if self.closed:
+                    return
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    condition.wait(delay)
+                    continue
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+            for tracked in due:
+                self.executor.submit(self.__poll, tracked)
+
+    def __poll(self, tracked):
+        from .error_codes import UMPushError, APIServerErrorCode
+
+        with self.condition:
+            self.polls += 1
+        try:
+            info = self.client.status(tracked.task_id)
+        except UMPushError as e:
+            if e.error_code in (APIServerErrorCode.NO_TASK_ID.value, APIServerErrorCode.NO_MESSAGE_EXIST.value):
+                return self.__finish(tracked, error=e)
+            return self.__retry(tracked, e)
+        except Exception as e:
+            return self.__retry(tracked, e)
+
+        tracked.errors = 0
+        if info.finished:
+            return self.__finish(tracked, info)
+        progress = (info.status, info.accept_count, info.sent_count)
+        if progress == tracked.progress:
+            tracked.interval = min(tracked.interval * self.backoff, self.max_interval)
+        else:
+            tracked.interval = self.min_interval
+            tracked.progress = progress
+        self.__schedule(tracked, tracked.interval)
+
+    def __retry(self, tracked, error):
+        tracked.errors += 1
+        if tracked.errors >= self.max_errors:
+            return self.__finish(tracked, error=error)
+        tracked.interval = min(tracked.interval * self.backoff, self.max_interval)
+        self.__schedule(tracked, tracked.interval)
+
+    def __finish(self, tracked, info=None, error=None):
+        with self.condition:
+            self.tracked.pop(tracked.task_id, None)
+        if error is not None:
+            log.logger.warning('umeng push task %s not tracked any more: %s', tracked.task_id,
+                               getattr(error, 'error_code', None) or type(error).__name__,
+                               extra={'task_id': tracked.task_id})
+            tracked.future.set_exception(error)
+            return
+        tracked.future.set_result(info)
+        for callback in tracked.callbacks + ([self.callback] if self.callback is not None else []):
+            try:
+                callback(info)
+            except Exception:
+                log.logger.exception('umeng push task callback failed')
+
+    def pending(self):
+        """
+        task ids that are not finished yet
+        """
+        with self.condition:
+            return list(self.tracked)
+
+    def stop(self, wait=True):
+        """
+        stop polling, futures of unfinished tasks are left pending
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=wait)
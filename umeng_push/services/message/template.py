@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'PayloadTemplate',
+    'CompiledMessage',
+]
+
+import struct
+
+from . import codec
+from .connect import UMMessage, DeviceType, MsgType, MAX_DEVICE_TOKENS, SERIAL_VERSION, _check_version
+
+
+_DEVICE_TOKENS = '__umeng_push_device_tokens__'
+_TIMESTAMP = '__umeng_push_timestamp__'
+_OUT_BIZ_NO = '__umeng_push_out_biz_no__'
+_TYPE = '__umeng_push_type__'
+_FIELDS = (_DEVICE_TOKENS, _TIMESTAMP, _OUT_BIZ_NO, _TYPE)
+
+_UNICAST = codec.dumps(MsgType.unicast.value)
+_LISTCAST = codec.dumps(MsgType.list_cast.value)
+
+# 序列化时每一段之前的长度
+_LENGTH = struct.Struct('>I')
+
+
+class PayloadTemplate(object):
+    """
+    request body encoded once, device_tokens, timestamp, out_biz_no and type are spliced in per send
+    type is unicast for one token and listcast for several
+    """
+
+    def __init__(self, params):
+        params = dict(params,
+                      device_tokens=_DEVICE_TOKENS,
+                      timestamp=_TIMESTAMP,
+                      type=_TYPE,
+                      policy=dict(params['policy'], out_biz_no=_OUT_BIZ_NO))
+        body = codec.dumps(params)
+
+        markers = []
+        for name in _FIELDS:
+            marker = codec.dumps(name)
+            markers.append((body.index(marker), len(marker), name))
+        markers.sort()
+
+        self.segments = []
+        self.fields = []
+        start = 0
+        for index, length, name in markers:
+            self.segments.append(body[start:index])
+            self.fields.append(name)
+            start = index + length
+        self.segments.append(body[start:])
+
+    @classmethod
+    def _from_parts(cls, segments, fields):
+        # restores an encoded template without building and encoding the params again
+        if sorted(fields) != sorted(_FIELDS) or len(segments) != len(fields) + 1:
+            raise ValueError('unsupported compiled message template')
+        template = cls.__new__(cls)
+        template.segments = segments
+        template.fields = fields
+        return template
+
+    def render(self, device_tokens, timestamp, out_biz_no):
+        values = {_DEVICE_TOKENS: codec.dumps(device_tokens),
+                  _TIMESTAMP: str(timestamp).encode(),
+                  _OUT_BIZ_NO: codec.dumps(out_biz_no),
+                  _TYPE: _LISTCAST if ',' in device_tokens else _UNICAST}
+        segments = self.segments
+        fields = self.fields
+        return b''.join((segments[0], values[fields[0]],
+                         segments[1], values[fields[1]],
+                         segments[2], values[fields[2]],
+                         segments[3], values[fields[3]],
+                         segments[4]))
+
+
+def _join_tokens(device_tokens):
+    if isinstance(device_tokens, str):
+        return device_tokens
+    device_tokens = list(device_tokens)
+    if len(device_tokens) > MAX_DEVICE_TOKENS:
+        from .error_codes import UMPushError, APIServerErrorCode
+
+        # the server would reject the request
+        raise UMPushError(APIServerErrorCode.DEVICE_TOKENS_GREATER_THAN_FIFTY, None)
+    return ','.join(map(str, device_tokens))
+
+
+class CompiledMessage(object):
+    """
+    a UMMessage and its notification compiled once for many sends, built by UMMessage.compile()
+    changes to the message after compile() are not seen
+    only unicasts and listcasts can be compiled, each send is a unicast or listcast of its own tokens
+    """
+
+    def __init__(self, message):
+        if message.type not in (MsgType.unicast, MsgType.list_cast):
+            raise ValueError('only unicast and listcast messages can be compiled')
+        self.message = message
+        # any non empty target builds the params of both platforms
+        android_params, ios_params = message._build_params({'device_tokens': ''}, {'device_tokens': ''})
+        self.templates = {DeviceType.android: PayloadTemplate(android_params),
+                          DeviceType.ios: PayloadTemplate(ios_params)}
+
+    def render(self, device_tokens, device_type, out_biz_no, timestamp):
+        """
+        :param device_tokens,  # 单个 token 或最多 MAX_DEVICE_TOKENS 个 token 的列表
+        :param device_type,  # DeviceType 或其 value
+        """
+        return self.templates[DeviceType(device_type)].render(_join_tokens(device_tokens), timestamp, out_biz_no)
+
+    def push(self, device_tokens, device_type, out_biz_no):
+        """
+        send the compiled payload to device_tokens of one platform
+        dead tokens of the message's token_registry are left out, and tokens the server reports invalid recorded
+        :param out_biz_no,  # 每次发送都需要新的唯一标识，服务器会根据这个标识避免重复发送。
+        :return MsgReturnData, None when no token is left to send
+        """
+        if isinstance(device_tokens, str):
+            device_tokens = [device_tokens]
+        if self.message.token_registry is not None:
+            device_tokens = self.message.token_registry.filter(device_tokens)
+        if not device_tokens:
+            return None
+        device_tokens = _join_tokens(device_tokens)
+        template = self.templates[DeviceType(device_type)]
+
+        def render(timestamp):
+            return template.render(device_tokens, timestamp, out_biz_no)
+
+        return self.message._push_recorded(render, platform=DeviceType(device_type).name,
+                                           device_tokens=device_tokens)
+
+    def to_bytes(self):
+        """
+        the message, as UMMessage.to_bytes, followed by the encoded templates of both platforms
+        a process loading it with from_bytes renders and sends without building or encoding params
+        """
+        parts = [self.message.to_bytes()]
+        for device_type in (DeviceType.android, DeviceType.ios):
+            template = self.templates[device_type]
+            parts.append(bytes(_FIELDS.index(name) for name in template.fields))
+            parts.extend(template.segments)
+        return bytes((SERIAL_VERSION, )) + b''.join(_LENGTH.pack(len(part)) + part for part in parts)
+
+    @classmethod
+    def from_bytes(cls, data, app_master_secret=None, **options):
+        """
+        same parameters as UMMessage.from_bytes
+        """
+        _check_version(data[0])
+        parts = []
+        offset = 1
+        while offset < len(data):
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            parts.append(data[offset:offset + length])
+            offset += length
+
+        compiled = cls.__new__(cls)
+        compiled.message = UMMessage.from_bytes(parts[0], app_master_secret, **options)
+        compiled.templates = {}
+        start = 1
+        for device_type in (DeviceType.android, DeviceType.ios):
+            fields = parts[start]
+            segments = parts[start + 1:start + 2 + len(fields)]
+            start += 2 + len(fields)
+            compiled.templates[device_type] = PayloadTemplate._from_parts(
+                segments, [_FIELDS[i] for i in fields if i < len(_FIELDS)])
+        return compiled
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'DeadTokenRegistry',
+    'BloomFilter',
+    'DEAD_TOKEN_ERROR_CODES',
+]
+
+import hashlib
+import math
+import threading
+
+from .error_codes import APIServerErrorCode
+
+
+# 这些错误码说明请求中的 device_token 已失效
+DEAD_TOKEN_ERROR_CODES = frozenset([
+    APIServerErrorCode.WRONG_DEVICE_TOKEN.value,
+    APIServerErrorCode.DEVICE_TOKEN_ALL_FAILED.value,
+    APIServerErrorCode.DEVICE_TOKEN_ERROR.value,
+    APIServerErrorCode.WRONG_DEVICE_TOKEN_FORMAT.value,
+])
+
+
+class BloomFilter(object):
+    """
+    fixed size bit array, `in` may return false positives at about error_rate but never false negatives
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, item):
+        digest = hashlib.md5(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.__positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(item))
+
+
+class DeadTokenRegistry(object):
+    """
+    device tokens known to be invalid, pruned from messages before they are built
+    """
+
+    def __init__(self,
+                 bloom_capacity=None,  # 设置后用 BloomFilter 代替 set 保存，适合超大量设备
+                 error_rate=0.001,
+                 ):
+        if bloom_capacity:
+            self.tokens = BloomFilter(bloom_capacity, error_rate)
+        else:
+            self.tokens = set()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.hits = 0  # 被过滤掉的失效 token
+        self.misses = 0  # 通过检查的 token
+        self.duplicates = 0  # 同一条消息中重复的 token
+
+    def add(self, token):
+        with self.lock:
+            if token not in self.tokens:
+                self.tokens.add(token)
+                self.count += 1
+
+    def update(self, tokens):
+        for token in tokens:
+            self.add(token)
+
+    def __contains__(self, token):
+        return token in self.tokens
+
+    def __len__(self):
+        return self.count
+
+    def record_error(self, device_tokens, error_code):
+        """
+        mark the tokens of a failed request as dead when the error code says they are invalid
+        :param device_tokens,  # device_tokens 参数，逗号分隔
+        """
+        if not device_tokens or int(error_code) not in DEAD_TOKEN_ERROR_CODES:
+            return
+        tokens = device_tokens.split(',')
+        # a listcast error does not tell which token failed unless all of them did
+        if len(tokens) == 1 or int(error_code) == APIServerErrorCode.DEVICE_TOKEN_ALL_FAILED.value:
+            self.update(tokens)
+
+    def filter(self, tokens):
+        """
+        return tokens without dead and duplicate tokens, in their original order
+        """
+        seen = set()
+        alive = []
+        dead_tokens = self.tokens
+        hits = duplicates = 0
+        for token in tokens:
+            if token in seen:
+                duplicates += 1
+            elif token in dead_tokens:
+                hits += 1
+            else:
+                seen.add(token)
+                alive.append(token)
+        with self.lock:
+            self.hits += hits
+            self.misses += len(alive)
+            self.duplicates += duplicates
+        return alive
+
+    def stats(self):
+        return {'dead': self.count, 'hits': self.hits, 'misses': self.misses, 'duplicates': self.duplicates}
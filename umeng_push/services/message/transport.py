@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__revision__ = '0.1'
+
+__all__ = [
+    'UMTransport',
+    'get_transport',
+    'configure_transport',
+]
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+
+class UMTransport(object):
+    """
+    keep-alive http client shared by every UMMessage of one process
+    """
+
+    def __init__(self,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,  # 缓存的host连接池个数
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,  # 每个host连接池保留的最大连接数
+                 pool_block=False,  # 连接池满时是否阻塞等待
+                 keep_alive=True,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 ):
+        """
+        :param pool_connections,  # 缓存的host连接池个数
+        :param pool_maxsize,  # 每个host连接池保留的最大连接数
+        :param keep_alive,  # False 时每个请求发送 Connection: close
+        :param connect_timeout, read_timeout  # 秒，None 表示不超时
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pid = os.getpid()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    def post(self, url, data, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, data=data, **kwargs)
+
+    def prewarm(self, url, connections=1):
+        """
+        open `connections` keep-alive connections to the host of url before the first push
+        """
+        if not self.keep_alive:
+            return
+        connections = min(connections, self.pool_maxsize)
+
+        def _touch():
+            try:
+                self.session.head(url, timeout=self.timeout)
+            except requests.RequestException:
+                pass
+
+        # concurrent requests are needed, a sequential loop would reuse one connection
+        threads = [threading.Thread(target=_touch) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_options = {}
+_transport_lock = threading.Lock()
+
+
+def configure_transport(**options):
+    """
+    set options of the process wide transport, see UMTransport.__init__
+    takes effect on the next get_transport()
+    """
+    global _transport, _transport_options
+    with _transport_lock:
+        _transport_options = options
+        old, _transport = _transport, None
+    if old is not None and old.pid == os.getpid():
+        old.close()
+
+
+def get_transport():
+    """
+    return the transport of the current process, a forked child never reuses the pool of its parent
+    """
+    global _transport
+    transport = _transport
+    if transport is None or transport.pid != os.getpid():
+        with _transport_lock:
+            if _transport is None or _transport.pid != os.getpid():
+                _transport = UMTransport(**_transport_options)
+            transport = _transport
+    return transport
+
+
+def _reset_after_fork():
+    global _transport, _transport_lock
+    # sockets and lock state inherited from the parent must not be touched by the child
+    _transport = None
+    _transport_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)